@@ -7,46 +7,138 @@ Created on Mon Nov  3 15:47:35 2025
 """
 
 import sys
+import inspect
+import threading
 from pathlib import Path
+from functools import wraps
+from collections import Counter
 from auth.role import Role
 
 
 class AccessControl:
+    """
+    Role-based access control. Each user's effective permissions (the union
+    of their roles' permissions) are computed once and kept in a set, so
+    has_permission is a single hash lookup. A user's set is dropped when
+    their roles change (assign_role / revoke_roles), and every set is dropped
+    when any role's permissions change (Role.generation).
+    
+    Users are identified by username. Role changes, set computations and the
+    check counters all happen under self.lock, so a check racing with a role
+    change can never cache the permissions the user had before it.
+    """
     def __init__(self):
-        self.user_roles = {}  # maps user_id → list of roles
+        self.user_roles = {}  # maps username → set of roles
+        self.__reset_cache()
+    
+    def __reset_cache(self):
+        self.lock = threading.Lock()
+        self.effective_permissions = {} # username -> frozenset of permissions
+        self.role_generation = Role.generation
+        self.checks = Counter() # permission -> times checked
+        self.denied = Counter() # permission -> times refused
+        self.rebuilds = 0 # effective permission sets computed
+    
+    # the precomputed sets and counters are not saved
+    def __getstate__(self):
+        return {"user_roles": self.user_roles}
+    
+    def __setstate__(self, state):
+        self.user_roles = state["user_roles"]
+        self.__reset_cache()
 
     # assign a role or list of roles to a user
-    def assign_role(self, user_id, role):
+    def assign_role(self, username, role):
         # make sure role is a Role or list of Roles
         if not isinstance(role,Role) and not isinstance(role,list):
             return False
         
-        if type(role)==Role:
-            self.user_roles.setdefault(user_id,set()).add(role)
-            return self.user_roles[user_id]
-        else:
-            for r in role:
-                self.user_roles.setdefault(user_id,set()).add(r)
-            return self.user_roles[user_id]
-
-    def has_permission(self, user_id, permission):
-        if user_id in self.user_roles.keys():
-            for role in self.user_roles[user_id]:
-                for p in role.permissions:
-                    if p == permission:
-                        return True
-        else: return False
-                
-    
-    def requires_permission(permission):
+        with self.lock:
+            if type(role)==Role:
+                self.user_roles.setdefault(username,set()).add(role)
+            else:
+                for r in role:
+                    self.user_roles.setdefault(username,set()).add(r)
+            # dropped once the roles have changed, so it is next computed from the new ones
+            self.effective_permissions.pop(username, None)
+            return self.user_roles[username]
+    
+    # removes every role of a user. Returns True if they had any
+    def revoke_roles(self, username):
+        with self.lock:
+            had_roles = self.user_roles.pop(username, None) is not None
+            self.effective_permissions.pop(username, None)
+            return had_roles
+
+    # returns an assigned Role with the given name, or None
+    def find_role(self, name):
+        with self.lock:
+            assigned = [list(roles) for roles in self.user_roles.values()]
+        for roles in assigned:
+            for role in roles:
+                if role.name == name:
+                    return role
+        return None
+    
+    # the set of permissions username has through all of their roles
+    def permissions_of(self, username):
+        with self.lock:
+            return self.__permissions_of(username)
+    
+    def __permissions_of(self, username):
+        if self.role_generation != Role.generation:
+            # some role's permissions changed since the sets were computed
+            self.effective_permissions = {}
+            self.role_generation = Role.generation
+        permissions = self.effective_permissions.get(username)
+        if permissions is None:
+            permissions = frozenset().union(*(role.permissions for role in self.user_roles.get(username, ())))
+            self.effective_permissions[username] = permissions
+            self.rebuilds += 1
+        return permissions
+
+    def has_permission(self, username, permission):
+        with self.lock:
+            self.checks[permission] += 1
+            if permission in self.__permissions_of(username):
+                return True
+            self.denied[permission] += 1
+            return False
+    
+    # permission-check counters: {"checks", "denied" (totals), "rebuilds" (permission sets
+    # computed), "by_permission": {permission: (checks, denied)}}
+    def stats(self):
+        with self.lock:
+            checks = dict(self.checks)
+            denied = dict(self.denied)
+            rebuilds = self.rebuilds
+        return {"checks": sum(checks.values()), "denied": sum(denied.values()), "rebuilds": rebuilds,
+                "by_permission": {p: (n, denied.get(p, 0)) for p, n in checks.items()}}
+    
+    def reset_stats(self):
+        with self.lock:
+            self.checks = Counter()
+            self.denied = Counter()
+            self.rebuilds = 0
+    
+    # decorator for methods of objects with an AccessControl as self.ac (eg. Library):
+    #     @requires_permission("add_item")
+    #     def add_item(self, book, user): ...
+    # raises PermissionError unless the method's user argument (user_arg, passed by position
+    # or keyword) has the permission
+    @staticmethod
+    def requires_permission(permission, user_arg="user"):
         def decorator(func):
-            def wrapper(self, user, *args, **kwargs):
-                # self must have a reference to AccessControl (e.g., self.ac)
-                if not self.ac.has_permission(user, permission):
-                    raise PermissionError(f"Access denied: {permission}")
-                return func(self, user, *args, **kwargs)
+            position = list(inspect.signature(func).parameters).index(user_arg) - 1 # after self
+            message = f"Access Denied: {permission}"
+            @wraps(func)
+            def wrapper(self, *args, **kwargs):
+                user = kwargs[user_arg] if user_arg in kwargs else args[position]
+                if not self.ac.has_permission(user.username, permission):
+                    raise PermissionError(message)
+                return func(self, *args, **kwargs)
             return wrapper
         return decorator
-    
 
 
+requires_permission = AccessControl.requires_permission
@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from auth.role import Role
+
+# the roles every front-end (the Tk app, the JSON service) registers users with
+MEMBER_PERMISSIONS = ["checkout_item","return_item"]
+ADMIN_PERMISSIONS = ["add_item","remove_item","process_checkout","get_days_overdue","get_overdue_copies","check_overdue","catalog_system","list_inv","load_state","save_state","set_date"]
+
+member_role = Role("member",MEMBER_PERMISSIONS)
+admin_role = Role("admin",ADMIN_PERMISSIONS)
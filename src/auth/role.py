@@ -7,11 +7,37 @@ Created on Mon Nov  3 15:45:09 2025
 """
 
 class Role: 
+    # bumped whenever any role's permissions change, so AccessControl knows its
+    # precomputed permission sets are stale
+    generation = 0
+    
     def __init__(self,name,permissions):
         self.name = name
-        self.permissions = set(permissions)
-        print(f">>> Initializing new RBAC role '{self.name}' with permissions: {self.permissions}\n")
+        self._permissions = frozenset(permissions)
+        print(f">>> Initializing new RBAC role '{self.name}' with permissions: {set(self._permissions)}\n")
+    
+    # roles saved when permissions was a plain (mutable) set
+    def __setstate__(self,state):
+        if 'permissions' in state:
+            state['_permissions'] = frozenset(state.pop('permissions'))
+        self.__dict__.update(state)
+    
+    # read-only: change permissions with grant / revoke (or by assigning a new collection)
+    @property
+    def permissions(self):
+        return self._permissions
+    
+    @permissions.setter
+    def permissions(self,permissions):
+        self._permissions = frozenset(permissions)
+        Role.generation += 1
+    
+    def grant(self,*permissions):
+        self.permissions = self._permissions.union(permissions)
+    
+    def revoke(self,*permissions):
+        self.permissions = self._permissions.difference(permissions)
         
     def __repr__(self):
-        return f"{self.name}: {self.permissions}"
+        return f"{self.name}: {set(self.permissions)}"
         
\ No newline at end of file
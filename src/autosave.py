@@ -0,0 +1,124 @@
+# autosave.py
+
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+
+class AutosaveService:
+    """
+    Saves the library from a background thread so the Tk main thread never
+    waits for the disk.
+
+    The thread polls the number of operations applied so far. Bursts of
+    operations are coalesced: a save happens once no new operation has come
+    in for quiet_period seconds, or max_delay seconds after the oldest unsaved
+    one if they keep coming. save(full=False) does the actual work (see
+    persistence.write_snapshot) and returns its stats, which are folded into
+    the latency metrics.
+    """
+
+    def __init__(self, save, mutation_count, quiet_period=2.0, max_delay=30.0):
+        self.save = save
+        self.mutation_count = mutation_count
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        self.thread = None
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.save_requested = False
+        self.saved_count = mutation_count() # operation count captured by the last successful save
+
+        self.saves = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_saved_at = None # time.time() of the last successful save
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = 0.0
+        self.max_capture_ms = 0.0 # longest time operations were held up by a save
+        self.metrics_lock = threading.Lock()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.__run, name="autosave", daemon=True)
+        self.thread.start()
+
+    # stops the thread, saving anything still unsaved first unless final_save is False
+    def stop(self, final_save=True, timeout=None):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.wakeup.set()
+        self.thread.join(timeout)
+        self.thread = None
+        if final_save:
+            self.save_now()
+
+    # asks for a save as soon as possible (eg. a journal checkpoint), without waiting for it
+    def request_save(self):
+        self.save_requested = True
+        self.wakeup.set()
+
+    # saves on the calling thread. Returns True on success
+    def save_now(self, full=False):
+        self.save_requested = False
+        count = self.mutation_count()
+        start = time.perf_counter()
+        try:
+            stats = self.save(full)
+        except Exception as e:
+            with self.metrics_lock:
+                self.failures += 1
+                self.last_error = str(e)
+            print(f"[PERSISTENCE ERROR] Autosave failed: {e}")
+            return False
+        elapsed = (time.perf_counter() - start) * 1000
+        with self.metrics_lock:
+            self.saved_count = count
+            self.saves += 1
+            self.last_ms = elapsed
+            self.total_ms += elapsed
+            self.max_ms = max(self.max_ms, elapsed)
+            self.max_capture_ms = max(self.max_capture_ms, stats.get("capture_ms", 0.0))
+            self.last_saved_at = time.time()
+        return True
+
+    def metrics(self):
+        with self.metrics_lock:
+            return {
+                "saves": self.saves,
+                "failures": self.failures,
+                "last_error": self.last_error,
+                "last_saved_at": self.last_saved_at,
+                "last_ms": self.last_ms,
+                "mean_ms": self.total_ms / self.saves if self.saves else 0.0,
+                "max_ms": self.max_ms,
+                "max_capture_ms": self.max_capture_ms,
+                "unsaved_operations": self.mutation_count() - self.saved_count,
+            }
+
+    def __run(self):
+        last_seen = self.saved_count
+        first_unsaved_at = None
+        while not self.stopping.is_set():
+            self.wakeup.wait(self.quiet_period)
+            self.wakeup.clear()
+            if self.stopping.is_set():
+                break
+
+            count = self.mutation_count()
+            now = time.monotonic()
+            if count == self.saved_count and not self.save_requested:
+                first_unsaved_at = None
+                continue
+            if first_unsaved_at is None:
+                first_unsaved_at = now
+            quiet = count == last_seen
+            last_seen = count
+            if self.save_requested or quiet or now - first_unsaved_at >= self.max_delay:
+                if self.save_now():
+                    first_unsaved_at = None
@@ -0,0 +1,201 @@
+# journal.py
+
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import threading
+from datetime import date
+from auth.role import Role
+from models.book import Book
+from models.csv_ingest import book_key
+from models.library import CirculationError
+
+
+class Journal:
+    """
+    Append-only operation journal (write-ahead log) for the Library.
+
+    The Library appends one JSON line per mutation as it happens, so saving an
+    operation costs O(1) instead of re-pickling the whole state. Every
+    checkpoint_every records the on_checkpoint callback (persistence.save_state)
+    writes a full snapshot and the journal is truncated. On startup the records
+    newer than the snapshot are replayed on top of it.
+    """
+
+    def __init__(self, path, checkpoint_every=200, fsync=False):
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self.fsync = fsync # fsync every record (slower, survives power loss)
+        self.on_checkpoint = None
+        self.records_since_checkpoint = 0
+        self.file = None
+        self.checkpointing = threading.Lock()
+
+    def open(self):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    # takes a due checkpoint. The Library calls this before an operation takes any of its
+    # locks, so the snapshot is written while no operation is half applied
+    def checkpoint_if_due(self):
+        if self.on_checkpoint is None or self.records_since_checkpoint < self.checkpoint_every:
+            return
+        # one thread checkpoints; the others carry on
+        if not self.checkpointing.acquire(blocking=False):
+            return
+        try:
+            if self.records_since_checkpoint >= self.checkpoint_every:
+                self.on_checkpoint()
+        finally:
+            self.checkpointing.release()
+
+    # writes one record. seq is the Library's journal sequence number. Callers serialize
+    # appends (Library.journal_lock)
+    def append(self, seq, op, args):
+        self.open()
+        self.file.write(json.dumps({"seq": seq, "op": op, "args": args}) + "\n")
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.records_since_checkpoint += 1
+
+    # called once a journaled operation has been applied (records are written ahead, so nothing to do)
+    def applied(self, seq, op, args, users=()):
+        pass
+
+    # empties the journal once a snapshot containing all its records has been written
+    def reset(self):
+        self.close()
+        with open(self.path, 'w', encoding='utf-8'):
+            pass
+        self.records_since_checkpoint = 0
+
+    # yields the records in the journal, stopping at a torn (partially written) last line
+    def read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f"[JOURNAL] Ignoring incomplete record at the end of {self.path}.")
+                        return
+        except FileNotFoundError:
+            return
+
+    # re-applies every record newer than the library's last saved sequence number.
+    # Returns the number of records replayed
+    def replay(self, library, userbase):
+        replayed = 0
+        saved_journal = library.journal
+        library.journal = None # replayed operations must not be journaled again
+        try:
+            for record in self.read():
+                if record["seq"] <= library.journal_seq:
+                    continue
+                apply = REPLAY_HANDLERS.get(record["op"])
+                if apply is None:
+                    print(f"[JOURNAL] Unknown operation '{record['op']}' (seq {record['seq']}). Skipping.")
+                else:
+                    try:
+                        apply(library, userbase, record["args"])
+                    except (CirculationError, PermissionError):
+                        # operations refused when first run (eg. joining a waitlist) are refused again
+                        pass
+                    except Exception as e:
+                        print(f"[ERROR] Failed to replay '{record['op']}' (seq {record['seq']}): "
+                              f"{type(e).__name__}: {e}")
+                library.journal_seq = record["seq"]
+                replayed += 1
+        finally:
+            library.journal = saved_journal
+        self.records_since_checkpoint = replayed
+        return replayed
+
+
+# =========================
+# Replay handlers: op -> function(library, userbase, args)
+# =========================
+
+def _user(userbase, user_id):
+    user = userbase.get(user_id)
+    if user is None:
+        raise KeyError(f"Unknown user ID in journal: {user_id}")
+    return user
+
+def _book(library, book_id):
+    book = library.books_by_id.get(book_id)
+    if book is None:
+        raise KeyError(f"Unknown book ID in journal: {book_id}")
+    return book
+
+def _replay_register_user(library, userbase, args):
+    roles = []
+    for role_args in args["roles"]:
+        role = library.ac.find_role(role_args["name"])
+        if role is None:
+            role = Role(role_args["name"], role_args["permissions"])
+        roles.append(role)
+    library.register_user(userbase, args["username"], roles)
+
+def _replay_checkout(library, userbase, args):
+    library.checkout_item(_book(library, args["book_id"]), _user(userbase, args["user_id"]))
+
+def _replay_return(library, userbase, args):
+    library.return_item(_book(library, args["book_id"]), _user(userbase, args["user_id"]))
+
+def _batch_items(library, userbase, args):
+    return [(_book(library, book_id), _user(userbase, user_id)) for book_id, user_id in args["items"]]
+
+def _replay_checkout_many(library, userbase, args):
+    library.checkout_many(_batch_items(library, userbase, args))
+
+def _replay_return_many(library, userbase, args):
+    library.return_many(_batch_items(library, userbase, args))
+
+# like an ingest, the book must get back the ID later records (eg. a remove_item) refer to.
+# A removed book added back keeps its old ID
+def _replay_add_item(library, userbase, args):
+    if args["book_id"] in library.books_by_id:
+        raise ValueError(f"Book ID {args['book_id']} in journal is already in use")
+    book = Book(args["title"], args["author"], args["genre"], args.get("subgenre"))
+    book.book_id = args["book_id"]
+    library.add_item(book, _user(userbase, args["user_id"]))
+
+def _replay_remove_item(library, userbase, args):
+    library.remove_item(_book(library, args["book_id"]), _user(userbase, args["user_id"]))
+
+def _replay_set_date(library, userbase, args):
+    library.set_date(date.fromisoformat(args["date"]), _user(userbase, args["user_id"]))
+
+def _replay_cleanup_user(library, userbase, args):
+    library.cleanup_user_data(_user(userbase, args["user_id"]), _user(userbase, args["admin_id"]))
+
+# the books must get the IDs they got when first ingested, or later records would refer to the wrong books
+def _replay_ingest_many(library, userbase, args):
+    if library.next_book_id != args["first_book_id"]:
+        raise ValueError(f"Ingest in journal starts at book ID {args['first_book_id']}, "
+                         f"but the next book ID is {library.next_book_id}")
+    rows = [(book_key(title, author), title, author, genre, subgenre) for title, author, genre, subgenre in args["books"]]
+    added, duplicates = library.add_catalog_rows(rows)
+    if duplicates:
+        raise ValueError(f"{duplicates} book(s) of the journaled ingest are already in the library")
+
+REPLAY_HANDLERS = {
+    "register_user": _replay_register_user,
+    "checkout": _replay_checkout,
+    "return": _replay_return,
+    "checkout_many": _replay_checkout_many,
+    "return_many": _replay_return_many,
+    "add_item": _replay_add_item,
+    "remove_item": _replay_remove_item,
+    "set_date": _replay_set_date,
+    "cleanup_user": _replay_cleanup_user,
+    "ingest_many": _replay_ingest_many,
+}
@@ -14,11 +14,12 @@ base_directory = Path.cwd()
 if base_directory not in sys.path:
     sys.path.append(base_directory)
 
-from persistence import load_state, save_state
+from persistence import load_state, save_state, start_autosave
 from models.library import Library
 from models.user import User
 from auth.role import Role
 from auth.access_control import AccessControl
+from auth.default_roles import member_role, admin_role # RBAC roles
 
 
 base_directory = Path.cwd()
@@ -31,18 +32,13 @@ dataset_filepath = base_directory.parent/"Sample Datasets"/"books_new.csv"
 library, userbase = load_state(dataset_filepath) 
 current_user = None
 inventory_count = 0 # NEW: Global variable for inventory status
-for user_id, user_obj in userbase.items():
-    if not hasattr(user_obj, 'checkout_history'):
-        user_obj.checkout_history = {}
+RESULTS_PER_PAGE = 50 # search results shown per page
         
 # Initialize Tkinter root window
 root = tk.Tk()
 main_content_frame = ttk.Frame(root)
 main_content_frame.pack(fill='both', expand=True)
 
-# Setup RBAC Roles
-member_role = Role("member",["checkout_item","return_item"])  
-admin_role = Role("admin",["add_item","remove_item","process_checkout","get_days_overdue","get_overdue_copies","check_overdue","catalog_system","list_inv","load_state","save_state","set_date"])
 
 # =========================
 # Inventory Loading Logic 
@@ -92,9 +88,20 @@ def save_state_and_exit():
     #Saves the global library object and userbase and closes the GUI
     global library, userbase, root
     
-    if save_state(library, userbase):
+    # stop the background autosave first, so this is the last save
+    if autosave is not None:
+        autosave.stop(final_save=False)
+    try:
+        saved = save_state(library, userbase)
+    except Exception as e:
+        print(f"[ERROR] Failed to save library state on exit: {e}")
+        saved = False
+    if saved:
         root.destroy()
     else:
+        # the app stays open, so changes must keep being saved in the background
+        if autosave is not None:
+            autosave.start()
         messagebox.showerror("Exit Error", "Failed to save library state. See console for details.")
 
 
@@ -108,14 +115,8 @@ def update_user_base(name_entry, frame_to_clear):
         messagebox.showerror("Error", "Please enter your name.")
         return
 
-    library.user_id_counter += 1
-    new_user_id = f"EECE{library.user_id_counter:04d}" 
-    
-    new_user_obj = User(user_name)
-    userbase[new_user_id] = new_user_obj
-    
-    # Assign default role to the new user
-    library.ac.assign_role(new_user_obj.username, [member_role])
+    # Create the user with the default role (journaled by the library)
+    new_user_id, new_user_obj = library.register_user(userbase, user_name, [member_role])
     
     clear_frame(frame_to_clear)
     
@@ -168,6 +169,7 @@ def show_overdue_report(user_obj):
     try:
         # library.check_overdue handles permission check internally
         overdue_copies = library.check_overdue(user_obj)
+        summary = library.loan_summary(user_obj)
         
         report_window = tk.Toplevel(root)
         report_window.title("Overdue Items Report")
@@ -179,23 +181,18 @@ def show_overdue_report(user_obj):
             report_text.pack(padx=20, pady=10)
             report_text.insert(tk.END, f"Overdue Items as of {library.current_date}:\n\n")
             
-            # To get book name, we now have to search inventory for the copy
-            for copy in overdue_copies:
-                days_overdue = (library.current_date - copy['return_date']).days
-                borrower = copy['borrowed_by'].username
-                
-                # Try to find the book name
-                book_name = "Unknown Book"
-                for book in library.inventory:
-                    if copy in book.copies:
-                        book_name = book.name
-                        break
-                        
+            # Each record already carries its book, borrower and days overdue
+            for record in overdue_copies:
                 report_text.insert(tk.END, 
-                                   f"Book: {book_name}\n"
-                                   f"  - Borrower: {borrower}\n"
-                                   f"  - Due Date: {copy['return_date']}\n"
-                                   f"  - Days Overdue: {days_overdue}\n\n")
+                                   f"Book: {record['book'].name}\n"
+                                   f"  - Borrower: {record['borrower'].username}\n"
+                                   f"  - Due Date: {record['return_date']}\n"
+                                   f"  - Days Overdue: {record['days_overdue']}\n\n")
+
+            # late fees owed by each borrower (computed for all loans at once)
+            report_text.insert(tk.END, f"{summary['overdue']} of {summary['loans']} checked-out copies are overdue.\n")
+            for borrower, fee in sorted(summary['late_fees'].items(), key=lambda item: -item[1]):
+                report_text.insert(tk.END, f"  - {borrower.username}: ${fee:.2f} in late fees\n")
 
             report_text.config(state=tk.DISABLED)
             
@@ -235,7 +232,12 @@ def show_catalog_report(admin_user):
                 
                 if username not in user_checkout_map:
                     user_checkout_map[username] = []
-                user_checkout_map[username].append(f"  - {book_title} (Due: {return_date})")
+                if record['status'] == 'waitlist':
+                    user_checkout_map[username].append(f"  - {book_title} (Waitlist position: {record['position']})")
+                elif record['status'] == 'hold':
+                    user_checkout_map[username].append(f"  - {book_title} (Hold, pick up by: {record['pickup_by']})")
+                else:
+                    user_checkout_map[username].append(f"  - {book_title} (Due: {return_date})")
 
             for username, items in user_checkout_map.items():
                 report_text.insert(tk.END, f"User: {username}\n")
@@ -246,12 +248,24 @@ def show_catalog_report(admin_user):
 
             report_text.config(state=tk.DISABLED)
             
+            ttk.Button(report_window, text="Export to CSV", command=lambda: export_catalog_report(admin_user)).pack(pady=5)
+            
         ttk.Button(report_window, text="Close", command=report_window.destroy).pack(pady=10)
 
     except PermissionError as e:
         messagebox.showerror("Permission Denied", str(e))
     except Exception as e:
         messagebox.showerror("Error", f"An unexpected error occurred while generating report: {e}")    
+
+def export_catalog_report(admin_user):
+    # streams the catalog to catalogSystem.csv (catalogSystem.parquet would write Parquet)
+    try:
+        count = library.export_catalog(admin_user, userbase.values())
+        messagebox.showinfo("Export Complete", f"Saved {count} records to catalogSystem.csv.")
+    except PermissionError as e:
+        messagebox.showerror("Permission Denied", str(e))
+    except Exception as e:
+        messagebox.showerror("Error", f"Failed to export the catalog: {e}")
             
 # --- Member Specific Handlers ---
 
@@ -303,10 +317,11 @@ def handle_return(book_entry, user_obj, frame):
         messagebox.showerror("System Error", str(e))
 
 
-def handle_search(search_term_entry, search_by_var, user_obj):
+def handle_search(search_term_entry, search_by_var, user_obj, available_only_var=None):
     #Processes search and displays results
     search_term = search_term_entry.get().strip()
     search_by = search_by_var.get()
+    available_only = available_only_var.get() if available_only_var is not None else False
     
     if not search_term:
         messagebox.showerror("Error", "Please enter a search term.")
@@ -317,10 +332,16 @@ def handle_search(search_term_entry, search_by_var, user_obj):
         messagebox.showerror("Error", "The library catalog is empty. Please check the console for CSV loading errors.")
         return
         
-    # Call the new library search_catalog method
-    results = library.search_catalog(search_term, search_by)
+    show_search_page(user_obj, search_term, search_by, 0, available_only)
+
+
+def show_search_page(user_obj, search_term, search_by, offset, available_only=False):
+    # Fetch one page of results (plus one extra to know if there is a next page)
+    results = library.search_catalog(search_term, search_by, limit=RESULTS_PER_PAGE + 1, offset=offset,
+                                     available_only=available_only)
+    has_more = len(results) > RESULTS_PER_PAGE
     
-    show_search_results(user_obj, results, search_term, search_by)
+    show_search_results(user_obj, results[:RESULTS_PER_PAGE], search_term, search_by, offset, has_more, available_only)
 
 
 # =========================
@@ -333,6 +354,11 @@ def show_admin_menu(user_obj):
     
     # System/Time Management
     ttk.Label(main_content_frame, text=f"Current Library Date: {library.current_date}").pack(pady=(5, 10))
+    if autosave is not None:
+        metrics = autosave.metrics()
+        ttk.Label(main_content_frame, text=f"Autosave: {metrics['saves']} saves, last {metrics['last_ms']:.0f} ms "
+                                           f"(max {metrics['max_ms']:.0f} ms), {metrics['unsaved_operations']} unsaved "
+                                           f"operation(s), {metrics['failures']} failure(s)").pack(pady=(0, 10))
 
     # Overdue Report Button
     ttk.Button(main_content_frame, text="View Overdue Items ⚠️", command=lambda: show_overdue_report(user_obj)).pack(pady=5, ipadx=20)
@@ -374,6 +400,7 @@ def show_library_menu(user_obj):
     ttk.Button(main_content_frame, text="Search for a Book📘", command=lambda: show_search_form(user_obj)).pack(pady=10, ipadx=10)
     ttk.Button(main_content_frame, text="Get Book Recommendations⭐", command=lambda: show_recommendations(user_obj)).pack(pady=10, ipadx=10)
     ttk.Button(main_content_frame, text="Return a Book ↩", command=lambda: book_return(user_obj)).pack(pady=10, ipadx=10)
+    ttk.Button(main_content_frame, text="My Holds ⏳", command=lambda: show_holds(user_obj)).pack(pady=10, ipadx=10)
     
     ttk.Button(main_content_frame, text="Logout", command=show_main_menu).pack(pady=20)
 
@@ -459,6 +486,32 @@ def book_return(user_obj):
         ttk.Button(main_content_frame, text="Back to Menu", command=lambda: show_library_menu(user_obj)).pack(pady=5)
 
 
+def show_holds(user_obj):
+    #Displays the books the user is waitlisted for and holds ready for pickup
+    clear_frame(main_content_frame)
+    ttk.Label(main_content_frame, text="My Holds⏳", font=('Arial', 16, 'bold')).pack(pady=10)
+    
+    holds = library.get_user_holds(user_obj)
+    
+    if not holds:
+        ttk.Label(main_content_frame, text="You have no books on hold.").pack(pady=10)
+    else:
+        holds_text = tk.Text(main_content_frame, height=8, width=50)
+        for i, hold in enumerate(holds):
+            if hold['status'] == 'ready':
+                holds_text.insert(tk.END, f"{i+1}. {hold['book'].name} | Ready - pick up by {hold['pickup_by']}\n")
+            else:
+                holds_text.insert(tk.END, f"{i+1}. {hold['book'].name} | Waitlist position: {hold['position']}\n")
+        holds_text.config(state=tk.DISABLED)
+        holds_text.pack(pady=5, padx=10)
+        ttk.Label(main_content_frame, text="Search for a ready book and double-click it to check it out.").pack(pady=5)
+    
+    if is_admin(user_obj):
+        ttk.Button(main_content_frame, text="Back to Admin Menu", command=lambda: show_admin_menu(user_obj)).pack(pady=20)
+    else:
+        ttk.Button(main_content_frame, text="Back to Menu", command=lambda: show_library_menu(user_obj)).pack(pady=20)
+
+
 # --- UI Functions ---
 
 def show_search_form(user_obj):
@@ -475,17 +528,42 @@ def show_search_form(user_obj):
     ttk.Radiobutton(search_frame, text="Title", variable=search_by_var, value='title').pack(side=tk.LEFT, padx=5)
     ttk.Radiobutton(search_frame, text="Author", variable=search_by_var, value='author').pack(side=tk.LEFT, padx=5)
     ttk.Radiobutton(search_frame, text="Genre", variable=search_by_var, value='genre').pack(side=tk.LEFT, padx=5)
+    ttk.Radiobutton(search_frame, text="Best Match", variable=search_by_var, value='relevance').pack(side=tk.LEFT, padx=5)
+    
+    available_only_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(main_content_frame, text="Available now only", variable=available_only_var).pack(pady=5)
     
     # Search Term Entry
     ttk.Label(main_content_frame, text="Search Term:").pack(pady=5)
     search_term_entry = ttk.Entry(main_content_frame, width=40)
     search_term_entry.pack(pady=5)
     
+    # Suggestions (updated as the user types)
+    suggestion_list = tk.Listbox(main_content_frame, height=5, width=40)
+    suggestion_list.pack(pady=5)
+    
+    def update_suggestions(event=None):
+        suggestion_list.delete(0, tk.END)
+        prefix = search_term_entry.get().strip()
+        for suggestion in library.autocomplete(prefix, search_by_var.get(), limit=5):
+            suggestion_list.insert(tk.END, suggestion)
+
+    def use_suggestion(event):
+        selection = suggestion_list.curselection()
+        if selection:
+            search_term_entry.delete(0, tk.END)
+            search_term_entry.insert(0, suggestion_list.get(selection[0]))
+            
+    search_term_entry.bind('<KeyRelease>', update_suggestions)
+    search_by_var.trace_add('write', lambda *args: update_suggestions())
+    suggestion_list.bind('<<ListboxSelect>>', use_suggestion)
+    suggestion_list.bind('<Double-1>', lambda event: handle_search(search_term_entry, search_by_var, user_obj, available_only_var))
+    
     # Search Button
     ttk.Button(
         main_content_frame, 
         text="Search Catalog 📚",
-        command=lambda: handle_search(search_term_entry, search_by_var, user_obj)
+        command=lambda: handle_search(search_term_entry, search_by_var, user_obj, available_only_var)
     ).pack(pady=10)
 
     # Back Button
@@ -495,10 +573,12 @@ def show_search_form(user_obj):
         ttk.Button(main_content_frame, text="Back to Menu", command=lambda: show_library_menu(user_obj)).pack(pady=20)
 
 
-def show_search_results(user_obj, results, search_term, search_by):
-    #Displays the results of a book search
+def show_search_results(user_obj, results, search_term, search_by, offset=0, has_more=False, available_only=False):
+    #Displays one page of the results of a book search
     clear_frame(main_content_frame)
     ttk.Label(main_content_frame, text=f"Search Results for '{search_term}' ({search_by})", font=('Arial', 16, 'bold')).pack(pady=10)
+    if offset > 0 or has_more:
+        ttk.Label(main_content_frame, text=f"Showing results {offset + 1}-{offset + len(results)}").pack()
     
     if not results:
         ttk.Label(main_content_frame, text="No books found matching your search.", foreground='red').pack(pady=10)
@@ -520,7 +600,7 @@ def show_search_results(user_obj, results, search_term, search_by):
         book_id_map = {}
         for i, book in enumerate(results):
             # Check availability (simple check for at least one copy being available)
-            is_available = any(copy['borrowed_by'] is None for copy in book.copies)
+            is_available = book.has_available_copy()
             availability_text = "🟢 Available" if is_available else "🟡 Waitlist"
             
             item_id = tree.insert("", tk.END, values=(book.name, book.author, book.genre), 
@@ -551,6 +631,15 @@ def show_search_results(user_obj, results, search_term, search_by):
         # Instruction Label
         ttk.Label(main_content_frame, text="Double-click a book to Check Out or Join Waitlist.", font=('Arial', 10)).pack(pady=5)
     
+    # Paging Buttons
+    if offset > 0 or has_more:
+        page_frame = ttk.Frame(main_content_frame)
+        page_frame.pack(pady=5)
+        if offset > 0:
+            ttk.Button(page_frame, text="Previous Page", command=lambda: show_search_page(user_obj, search_term, search_by, max(0, offset - RESULTS_PER_PAGE), available_only)).pack(side=tk.LEFT, padx=5)
+        if has_more:
+            ttk.Button(page_frame, text="Next Page", command=lambda: show_search_page(user_obj, search_term, search_by, offset + RESULTS_PER_PAGE, available_only)).pack(side=tk.LEFT, padx=5)
+    
     # Back to Search Button
     ttk.Button(main_content_frame, text="New Search", command=lambda: show_search_form(user_obj)).pack(pady=10)
     
@@ -587,7 +676,7 @@ def show_recommendations(user_obj):
 
         book_id_map = {}
         for i, book in enumerate(recommendations):
-            is_available = any(copy['borrowed_by'] is None for copy in book.copies)
+            is_available = book.has_available_copy()
             availability_text = "🟢 Available" if is_available else "🟡 Waitlist"
             
             item_id = tree.insert("", tk.END, values=(book.name, book.author, book.genre))
@@ -672,12 +761,12 @@ root.resizable(True, True)
 
 # Initialize a default admin user if the userbase is empty
 if not userbase:
-    admin = User("admin")
-    library.ac.assign_role(admin.username, [admin_role,member_role])
-    library.user_id_counter += 1
-    admin_id = f"EECE{library.user_id_counter:04d}"
-    userbase[admin_id] = admin 
+    admin_id, admin = library.register_user(userbase, "admin", [admin_role,member_role])
     print(f"[SETUP] Default admin created with ID: {admin_id}")
 
+# save in the background from now on, and when the window is closed
+autosave = start_autosave(library, userbase)
+root.protocol("WM_DELETE_WINDOW", save_state_and_exit)
+
 show_main_menu()
 root.mainloop()
@@ -1,45 +1,269 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from array import array
+from datetime import date
 from models.waitlist import Waitlist
 from models.user import User
 
+# dates are stored as ordinals (date.toordinal()); 0 means no date
+NO_DATE = 0
+
+def _to_ordinal(day):
+    return NO_DATE if day is None else day.toordinal()
+
+def _from_ordinal(ordinal):
+    return None if ordinal == NO_DATE else date.fromordinal(ordinal)
+
+
+class CopyView:
+    """
+    Dict-like view of one copy of a book, for code written when copies were
+    dicts: copy["borrowed_by"], copy["borrow_date"], copy["return_date"] and
+    copy["slot"] read (and, except "slot", write) the book's copy arrays.
+    Two views of the same copy are equal.
+    """
+    __slots__ = ('book', 'slot')
+    KEYS = ("borrowed_by", "borrow_date", "return_date", "slot")
+
+    def __init__(self, book, slot):
+        self.book = book
+        self.slot = slot
+
+    def __getitem__(self, key):
+        book = self.book
+        if key == "slot":
+            return self.slot
+        if key == "borrowed_by":
+            return book.borrower(self.slot)
+        if key == "borrow_date":
+            return book.borrow_date(self.slot)
+        if key == "return_date":
+            return book.return_date(self.slot)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        book = self.book
+        if key == "borrowed_by":
+            book.set_copy(self.slot, value, book.borrow_date(self.slot), book.return_date(self.slot))
+        elif key == "borrow_date":
+            book.set_copy(self.slot, book.borrower(self.slot), value, book.return_date(self.slot))
+        elif key == "return_date":
+            book.set_copy(self.slot, book.borrower(self.slot), book.borrow_date(self.slot), value)
+        else:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.KEYS)
+
+    def items(self):
+        return [(key, self[key]) for key in self.KEYS]
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __eq__(self, other):
+        if not isinstance(other, CopyView):
+            return NotImplemented
+        return self.book is other.book and self.slot == other.slot
+
+    def __hash__(self):
+        return hash((id(self.book), self.slot))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 class Book:
-    
-    def __init__(self,name,author,genre):
+    """
+    A title in the catalog and its copies.
+
+    Copy state lives in parallel arrays indexed by copy slot (borrower, borrow
+    and return date ordinals) that are only allocated once a copy is first
+    checked out, and the waitlist is only created once someone queues, so a
+    book nobody has borrowed is a single object. book.copies / get_copy()
+    give dict-like views of the copies.
+    """
+    __slots__ = ('name', 'author', 'genre', 'subgenre', 'book_id', 'num_copies',
+                 'borrowers', 'borrow_dates', 'return_dates', 'free_slots', '_waitlist')
+
+    def __init__(self,name,author,genre,subgenre=None):
         self.name = name
         self.author = author
         self.genre = genre
-        self.copies = self.make_copies(3)
-        self.waitlist = Waitlist(self)
-        
+        self.subgenre = subgenre
+        self.book_id = None # assigned by the Library when the book is added
+        self._waitlist = None
+        self.make_copies(3)
+
+    # (re)creates num_copies copies, all on the shelf
     def make_copies(self,num_copies):
-        copies = []
-        for i in range(num_copies):
-            copy = {"borrowed_by":None,"borrow_date":None,"return_date":None}
-            copies.append(copy)
-        return copies
-    
+        self.num_copies = num_copies
+        # None until a copy is first checked out: every copy is on the shelf
+        self.borrowers = None # slot -> User or None
+        self.borrow_dates = None # array of date ordinals
+        self.return_dates = None
+        self.free_slots = None
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in Book.__slots__}
+
+    def __setstate__(self,state):
+        legacy_copies = state.pop('copies', None)
+        if 'waitlist' in state:
+            state['_waitlist'] = state.pop('waitlist')
+        state.setdefault('subgenre', None)
+        state.setdefault('book_id', None)
+        state.setdefault('_waitlist', None)
+        for name in Book.__slots__:
+            setattr(self, name, state.get(name))
+        if legacy_copies is not None:
+            # books saved when each copy was a dict
+            self.make_copies(len(legacy_copies))
+            for slot, copy in enumerate(legacy_copies):
+                # users' checked-out items still point at these dicts; the slot lets
+                # Library.rebuild_indexes swap them for views
+                copy["slot"] = slot
+                if copy.get("borrowed_by") is not None:
+                    self.set_copy(slot, copy["borrowed_by"], copy.get("borrow_date"), copy.get("return_date"))
+            self.rebuild_availability()
+
+    # the book's waitlist, created the first time it is needed
+    @property
+    def waitlist(self):
+        if self._waitlist is None:
+            self._waitlist = Waitlist(self)
+        return self._waitlist
+
+    @waitlist.setter
+    def waitlist(self,waitlist):
+        self._waitlist = waitlist
+
+    # True if someone is (or was) waiting for this book; checking does not create a waitlist
+    def has_waitlist(self):
+        return self._waitlist is not None
+
+    # frees the waitlist once nobody is queued and no hold is waiting to be picked up
+    def drop_empty_waitlist(self):
+        if self._waitlist is not None and len(self._waitlist) == 0 and not self._waitlist.holds_pending:
+            self._waitlist = None
+
+    # users waiting, in order, and (user, pickup deadline) holds, without creating a waitlist
+    def waiting_users(self):
+        return [] if self._waitlist is None else self._waitlist.queue
+
+    def pending_holds(self):
+        return () if self._waitlist is None else self._waitlist.holds_pending
+
+    # =========================
+    # Copies
+    # =========================
+
+    def __allocate_copies(self):
+        self.borrowers = [None] * self.num_copies
+        self.borrow_dates = array('i', [NO_DATE] * self.num_copies)
+        self.return_dates = array('i', [NO_DATE] * self.num_copies)
+        # kept as a stack with the lowest slot on top, so copies are handed out in order
+        self.free_slots = list(reversed(range(self.num_copies)))
+
+    @property
+    def copies(self):
+        return [CopyView(self, slot) for slot in range(self.num_copies)]
+
+    def get_copy(self,slot):
+        return CopyView(self, slot)
+
+    def borrower(self,slot):
+        return None if self.borrowers is None else self.borrowers[slot]
+
+    def borrow_date(self,slot):
+        return None if self.borrow_dates is None else _from_ordinal(self.borrow_dates[slot])
+
+    def return_date(self,slot):
+        return None if self.return_dates is None else _from_ordinal(self.return_dates[slot])
+
+    # records a copy's borrower and dates (all None puts it back on the shelf). The
+    # free-list is left alone: see acquire_copy / release_copy / rebuild_availability
+    def set_copy(self,slot,borrower,borrow_date,return_date):
+        if self.borrowers is None:
+            if borrower is None and borrow_date is None and return_date is None:
+                return
+            self.__allocate_copies()
+        self.borrowers[slot] = borrower
+        self.borrow_dates[slot] = _to_ordinal(borrow_date)
+        self.return_dates[slot] = _to_ordinal(return_date)
+
+    # (slot, borrower, return date) for every copy that is checked out
+    def checked_out_copies(self):
+        if self.borrowers is None:
+            return []
+        return [(slot, borrower, _from_ordinal(self.return_dates[slot]))
+                for slot, borrower in enumerate(self.borrowers) if borrower is not None]
+
+    # rebuilds the free-list of copy slots from the copies (also used to upgrade older saved books)
+    def rebuild_availability(self):
+        if self.borrowers is None:
+            self.free_slots = None
+            return
+        self.free_slots = []
+        # kept as a stack with the lowest slot on top, so copies are handed out in order
+        for slot in reversed(range(self.num_copies)):
+            if self.borrowers[slot] is None:
+                self.free_slots.append(slot)
+
+    def available_count(self):
+        if self.free_slots is None:
+            return self.num_copies
+        return len(self.free_slots)
+
+    def has_available_copy(self):
+        return self.available_count() > 0
+
+    # takes a free copy off the free-list in O(1). Returns None if every copy is checked out
+    def acquire_copy(self):
+        if self.free_slots is None:
+            if self.num_copies == 0:
+                return None
+            self.__allocate_copies()
+        if not self.free_slots:
+            return None
+        return CopyView(self, self.free_slots.pop())
+
+    # puts a copy back on the free-list once its checkout information has been cleared
+    def release_copy(self,copy):
+        slot = copy["slot"]
+        if self.free_slots is not None and slot not in self.free_slots:
+            self.free_slots.append(slot)
+
     def locate_copies(self):
         info = ""
         for copy in self.copies:
-            if copy["borrowed_by"] == None: 
+            if copy["borrowed_by"] == None:
                 borrower = "<empty>"
             else:
                 borrower = copy["borrowed_by"].username
             if copy["borrow_date"] == None:
                 borrow_date = "<empty>"
-            else: 
+            else:
                 borrow_date = copy["borrow_date"]
             if copy["return_date"] == None:
                 return_date = "<empty>"
             info += borrower + " - " + str(borrow_date) + "," + str(return_date)
         return info
-    
+
     def __str__(self):
           return self.name
-     
+
     def __repr__(self):
-        return f"{self.name},'{self.author}',{self.genre},{len(self.copies)}"
-        
-    
\ No newline at end of file
+        return f"{self.name},'{self.author}',{self.genre},{self.num_copies}"
+
+
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import csv
+from pathlib import Path
+
+# pyarrow is optional: without it catalogs can only be exported as CSV
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.ipc as ipc
+except ImportError:
+    pa = None
+
+# columns of a catalog record (see Library.iter_catalog)
+CATALOG_FIELDS = ["username", "user_id", "book_id", "book_title", "status",
+                  "borrow_date", "return_date", "position", "pickup_by"]
+
+# records per batch written to columnar files
+DEFAULT_BATCH_SIZE = 10000
+
+# export formats by file extension
+FORMATS = {".csv": "csv", ".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow", ".ipc": "arrow"}
+
+
+def columnar_available():
+    return pa is not None
+
+
+# writes catalog records (dicts) to path as they are produced, without collecting them first.
+# fmt is "csv", "parquet" or "arrow" (Arrow IPC), by default taken from the file extension.
+# Returns the number of records written
+def export_records(records, path, fmt=None):
+    fmt = fmt or FORMATS.get(Path(path).suffix.lower(), "csv")
+    if fmt == "csv":
+        return write_csv(records, path)
+    if fmt not in ("parquet", "arrow"):
+        raise ValueError(f"Unknown export format: {fmt}")
+    if pa is None:
+        raise ImportError(f"Exporting to {fmt} requires pyarrow (pip install pyarrow)")
+    return write_columnar(records, path, fmt)
+
+def write_csv(records, path):
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=CATALOG_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            count += 1
+    return count
+
+def _schema():
+    return pa.schema([
+        ("username", pa.string()),
+        ("user_id", pa.string()),
+        ("book_id", pa.int64()),
+        ("book_title", pa.string()),
+        ("status", pa.string()),
+        ("borrow_date", pa.date32()),
+        ("return_date", pa.date32()),
+        ("position", pa.int64()),
+        ("pickup_by", pa.date32()),
+    ])
+
+# writes the records in batches of batch_size, so only one batch is in memory at a time
+def write_columnar(records, path, fmt, batch_size=DEFAULT_BATCH_SIZE):
+    schema = _schema()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(path, schema)
+        write_batch = writer.write_batch
+    else:
+        sink = pa.OSFile(str(path), 'wb')
+        writer = ipc.new_file(sink, schema)
+        write_batch = writer.write_batch
+
+    count = 0
+    try:
+        columns = {name: [] for name in CATALOG_FIELDS}
+        for record in records:
+            for name in CATALOG_FIELDS:
+                columns[name].append(record.get(name))
+            count += 1
+            if count % batch_size == 0:
+                write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+                columns = {name: [] for name in CATALOG_FIELDS}
+        if count % batch_size or count == 0:
+            write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+    finally:
+        writer.close()
+        if fmt != "parquet":
+            sink.close()
+    return count
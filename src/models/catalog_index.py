@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import math
+import heapq
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+
+# searchable Book fields, mapped to the attribute that holds them
+INDEXED_FIELDS = {'title': 'name', 'author': 'author', 'genre': 'genre', 'subgenre': 'subgenre'}
+
+# relative weight of a match in each field when ranking results
+FIELD_WEIGHTS = {'title': 2.0, 'author': 1.5, 'genre': 1.0, 'subgenre': 1.0}
+
+# BM25 tuning constants (standard defaults)
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# a token is a run of letters/digits (underscores split tokens, eg. "signal_processing")
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+# compound queries look like "author=Foreman AND genre=tech"
+QUERY_CLAUSE_SEPARATOR = re.compile(r"\s+and\s+", re.IGNORECASE)
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+# returns the set of overlapping 3-character substrings of an already lowercased string
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class CatalogIndex:
+    """
+    Inverted indexes for each searchable field: token -> books and
+    trigram -> books, plus a sorted array of distinct values for prefix
+    completion. Kept up to date by the Library whenever books are added
+    or removed, so a search only touches the books that can contain the term.
+    """
+
+    # bumped whenever the index layout changes, so saved indexes get rebuilt
+    VERSION = 5
+
+    def __init__(self):
+        self.version = self.VERSION
+        # field -> token -> {book: term frequency}  (dicts keep insertion order)
+        self.postings = {field: {} for field in INDEXED_FIELDS}
+        # field -> book -> number of tokens in the value, plus the per-field total (for BM25)
+        self.field_lengths = {field: {} for field in INDEXED_FIELDS}
+        self.total_lengths = {field: 0 for field in INDEXED_FIELDS}
+        # field -> trigram of the lowercased value -> {book: None}
+        self.trigrams = {field: {} for field in INDEXED_FIELDS}
+        # field -> sorted list of distinct lowercased values (searched with bisect)
+        self.sorted_values = {field: [] for field in INDEXED_FIELDS}
+        # field -> lowercased value -> [display value, number of books with it]
+        self.value_counts = {field: {} for field in INDEXED_FIELDS}
+        # book -> sequence number, used to return results in inventory order
+        self.order = {}
+        self.next_seq = 0
+        self.bulk_depth = 0 # inside bulk(): sorted_values are sorted on the way out
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, book):
+        return book in self.order
+
+    @staticmethod
+    def field_value(book, field):
+        return getattr(book, INDEXED_FIELDS[field])
+
+    # yields (field, value) for every indexed field the book has a value for
+    def __indexed_values(self, book):
+        for field in INDEXED_FIELDS:
+            value = getattr(book, INDEXED_FIELDS[field], None)
+            if value is not None:
+                yield field, str(value)
+
+    # adds a book to every field's posting lists
+    def add(self, book):
+        if book in self.order:
+            return
+        self.order[book] = self.next_seq
+        self.next_seq += 1
+        for field, value in self.__indexed_values(book):
+            tokens = tokenize(value)
+            for token in tokens:
+                posting = self.postings[field].setdefault(token, {})
+                posting[book] = posting.get(book, 0) + 1
+            self.field_lengths[field][book] = len(tokens)
+            self.total_lengths[field] += len(tokens)
+            for gram in trigrams(value.lower()):
+                self.trigrams[field].setdefault(gram, {})[book] = None
+            self.__add_value(field, value)
+
+    # for loading many books at once (with index.bulk(): add...): new distinct values are
+    # appended and each field's values sorted once at the end, instead of an O(n) insort each
+    @contextmanager
+    def bulk(self):
+        self.bulk_depth = getattr(self, 'bulk_depth', 0) + 1
+        try:
+            yield self
+        finally:
+            self.bulk_depth -= 1
+            if not self.bulk_depth:
+                for values in self.sorted_values.values():
+                    values.sort()
+
+    # removes a book from every field's posting lists, dropping empty tokens
+    def remove(self, book):
+        if book not in self.order:
+            return
+        del self.order[book]
+        for field, value in self.__indexed_values(book):
+            self.__discard(self.postings[field], set(tokenize(value)), book)
+            self.total_lengths[field] -= self.field_lengths[field].pop(book, 0)
+            self.__discard(self.trigrams[field], trigrams(value.lower()), book)
+            self.__remove_value(field, value)
+
+    def __add_value(self, field, value):
+        key = value.lower()
+        entry = self.value_counts[field].get(key)
+        if entry is None:
+            self.value_counts[field][key] = [value, 1]
+            if getattr(self, 'bulk_depth', 0):
+                self.sorted_values[field].append(key)
+            else:
+                insort(self.sorted_values[field], key)
+        else:
+            entry[1] += 1
+
+    def __remove_value(self, field, value):
+        key = value.lower()
+        entry = self.value_counts[field].get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self.value_counts[field][key]
+            values = self.sorted_values[field]
+            if getattr(self, 'bulk_depth', 0):
+                values.remove(key) # not sorted yet
+                return
+            pos = bisect_left(values, key)
+            if pos < len(values) and values[pos] == key:
+                del values[pos]
+
+    @staticmethod
+    def __discard(field_postings, keys, book):
+        for key in keys:
+            posting = field_postings.get(key)
+            if posting is None:
+                continue
+            posting.pop(book, None)
+            if not posting:
+                del field_postings[key]
+
+    def clear(self):
+        self.__init__()
+
+    # returns the set of books that may contain search_term in field, or None if
+    # the term has nothing to look up (eg. punctuation only) and cannot be narrowed
+    def candidates(self, field, search_term):
+        term_lower = search_term.lower()
+        if len(term_lower) >= 3:
+            return self.__trigram_candidates(field, term_lower)
+        return self.__token_candidates(field, search_term)
+
+    # every trigram of the term must occur in a matching value: intersect their postings
+    def __trigram_candidates(self, field, term_lower):
+        field_grams = self.trigrams[field]
+        postings = []
+        for gram in trigrams(term_lower):
+            posting = field_grams.get(gram)
+            if posting is None:
+                return set()
+            postings.append(posting)
+
+        postings.sort(key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            result.intersection_update(posting)
+            if not result:
+                break
+        return result
+
+    # short terms (under 3 characters) are narrowed through the token vocabulary
+    def __token_candidates(self, field, search_term):
+        term_tokens = set(tokenize(search_term))
+        if not term_tokens:
+            return None
+
+        field_postings = self.postings[field]
+        candidate_sets = []
+        for term_token in term_tokens:
+            # every token of a substring match lies inside some token of the field,
+            # so union the postings of all vocabulary tokens containing term_token
+            matches = set()
+            for token, posting in field_postings.items():
+                if term_token in token:
+                    matches.update(posting)
+            if not matches:
+                return set()
+            candidate_sets.append(matches)
+
+        candidate_sets.sort(key=len)
+        result = candidate_sets[0]
+        for other in candidate_sets[1:]:
+            result = result & other
+            if not result:
+                break
+        return result
+
+    # returns up to limit distinct values of field starting with prefix (case-insensitive),
+    # in alphabetical order. Cost is O(log n + limit) regardless of catalog size.
+    # 'relevance' (which searches every field) completes from every field
+    def complete(self, field, prefix, limit=10):
+        if field == 'relevance':
+            completions = {}
+            for indexed_field in INDEXED_FIELDS:
+                for value in self.complete(indexed_field, prefix, limit):
+                    completions.setdefault(value.lower(), value)
+            return [completions[key] for key in sorted(completions)[:limit]]
+        if field not in INDEXED_FIELDS or limit <= 0:
+            return []
+        prefix = prefix.lower()
+        values = self.sorted_values[field]
+        counts = self.value_counts[field]
+
+        completions = []
+        pos = bisect_left(values, prefix)
+        while pos < len(values) and len(completions) < limit:
+            key = values[pos]
+            if not key.startswith(prefix):
+                break
+            completions.append(counts[key][0])
+            pos += 1
+        return completions
+
+    # BM25 relevance search over the given fields. Only the top offset + limit hits are
+    # kept (bounded heap), and the page [offset, offset + limit) is returned as
+    # a list of (score, book), best first. book_filter optionally drops books before ranking
+    def rank(self, search_term, fields=None, limit=20, offset=0, book_filter=None):
+        if fields is None:
+            fields = list(INDEXED_FIELDS)
+        term_tokens = set(tokenize(search_term))
+        num_books = len(self.order)
+        if not term_tokens or num_books == 0 or limit <= 0:
+            return []
+
+        scores = {}
+        for field in fields:
+            if field not in INDEXED_FIELDS:
+                continue
+            weight = FIELD_WEIGHTS.get(field, 1.0)
+            lengths = self.field_lengths[field]
+            avg_length = (self.total_lengths[field] / len(lengths)) if lengths else 0
+            for token in term_tokens:
+                posting = self.postings[field].get(token)
+                if not posting:
+                    continue
+                idf = math.log(1 + (num_books - len(posting) + 0.5) / (len(posting) + 0.5))
+                for book, tf in posting.items():
+                    norm = 1 - BM25_B + BM25_B * (lengths.get(book, 0) / avg_length if avg_length else 0)
+                    score = weight * idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+                    scores[book] = scores.get(book, 0.0) + score
+
+        if book_filter is not None:
+            scores = {book: score for book, score in scores.items() if book_filter(book)}
+
+        # ties are broken by inventory order
+        top = heapq.nlargest(offset + limit, scores.items(),
+                             key=lambda item: (item[1], -self.order.get(item[0], 0)))
+        return [(score, book) for book, score in top[offset:]]
+
+    # case-insensitive substring search, returning books in inventory order
+    def search(self, field, search_term, inventory=None):
+        if field not in INDEXED_FIELDS:
+            return []
+        term_lower = search_term.lower()
+
+        candidates = self.candidates(field, search_term)
+        if candidates is None:
+            candidates = self.order if inventory is None else inventory
+
+        results = []
+        for book in candidates:
+            if self.matches(book, field, term_lower):
+                results.append(book)
+        results.sort(key=lambda b: self.order.get(b, 0))
+        return results
+
+    # exact check of the search semantics: term_lower is a substring of the lowercased value
+    def matches(self, book, field, term_lower):
+        value = getattr(book, INDEXED_FIELDS[field], None)
+        # Handles cases where the book object might be missing the attribute
+        if value is None:
+            return False
+        return term_lower in str(value).lower()
+
+    # estimated number of candidates for a predicate, without building the candidate set.
+    # Trigram terms are bounded by their rarest trigram; short terms are not estimated
+    def estimate(self, field, search_term):
+        term_lower = search_term.lower()
+        if len(term_lower) < 3:
+            return len(self.order)
+        field_grams = self.trigrams[field]
+        return min(len(field_grams.get(gram, ())) for gram in trigrams(term_lower))
+
+    # evaluates a list of (field, term) predicates joined by AND. Predicates are planned
+    # by estimated selectivity: the most selective one produces candidates from its
+    # posting lists, the rest are intersected in while that is cheaper than verifying
+    # them directly on the (shrinking) candidate set
+    def query(self, predicates):
+        for field, term in predicates:
+            if field not in INDEXED_FIELDS:
+                raise ValueError(f"Invalid search category: {field}")
+        if not predicates:
+            return []
+
+        plan = sorted(predicates, key=lambda p: self.estimate(p[0], p[1]))
+        result = None
+        for field, term in plan:
+            # once the candidates are fewer than this predicate's postings, checking
+            # them directly (below) is cheaper than intersecting
+            if result is not None and len(result) <= self.estimate(field, term):
+                break
+            candidates = self.candidates(field, term)
+            if candidates is None:
+                continue
+            result = set(candidates) if result is None else result & candidates
+            if not result:
+                return []
+        if result is None:
+            result = self.order
+
+        # posting lists only narrow candidates, so every predicate is verified
+        results = []
+        for book in result:
+            if all(self.matches(book, field, term.lower()) for field, term in predicates):
+                results.append(book)
+        results.sort(key=lambda b: self.order.get(b, 0))
+        return results
+
+    # parses "field=term AND field=term ..." into a list of (field, term) predicates
+    @staticmethod
+    def parse_query(text):
+        predicates = []
+        for clause in QUERY_CLAUSE_SEPARATOR.split(text.strip()):
+            if '=' not in clause:
+                raise ValueError(f"Invalid query clause (expected field=term): '{clause}'")
+            field, term = clause.split('=', 1)
+            field = field.strip().lower()
+            term = term.strip().strip('"').strip("'")
+            if field not in INDEXED_FIELDS:
+                raise ValueError(f"Invalid search category: {field}")
+            if not term:
+                raise ValueError(f"Empty search term for '{field}'")
+            predicates.append((field, term))
+        return predicates
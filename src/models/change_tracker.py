@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+class ChangeTracker:
+    """
+    Remembers what the Library changed since the last save: books whose copies
+    or waitlist changed (or that were added), books that were removed, user
+    records and users whose role assignments changed. An incremental snapshot
+    (see snapshot.py) only writes these instead of the whole state.
+    """
+
+    def __init__(self):
+        self.books = {} # book_id -> Book
+        self.removed_books = set() # book_ids
+        self.users = {} # user_id -> User
+        self.roles = set() # usernames whose roles in AccessControl.user_roles changed
+        self.full = False # set when only a full snapshot can capture the changes
+        self.mutations = 0 # operations applied so far (never reset), to tell when there is something to save
+
+    def __bool__(self):
+        return bool(self.books or self.removed_books or self.users or self.roles or self.full)
+
+    def mark_book(self, book):
+        self.books[book.book_id] = book
+        self.removed_books.discard(book.book_id)
+
+    def mark_removed(self, book):
+        self.books.pop(book.book_id, None)
+        self.removed_books.add(book.book_id)
+
+    def mark_user(self, user):
+        self.users[user.user_id] = user
+
+    def mark_roles(self, username):
+        self.roles.add(username)
+
+    def mark_all(self):
+        self.full = True
+
+    def clear(self):
+        self.books.clear()
+        self.removed_books.clear()
+        self.users.clear()
+        self.roles.clear()
+        self.full = False
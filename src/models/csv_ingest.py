@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import hashlib
+import pandas as pd
+
+REQUIRED_COLUMNS = ['Title','Author','Genre']
+OPTIONAL_COLUMNS = ['SubGenre'] # only some datasets have it
+
+# rows read from the CSV at a time; peak memory depends on this, not the file size
+DEFAULT_CHUNKSIZE = 10000
+
+
+# reads a book dataset (CSV format) in chunks and yields one tuple per row:
+# (row_number, title, author, genre, subgenre) of strings. Blank values are None and
+# row numbers count data rows from 1. Raises ValueError if a required column is missing
+def iter_csv_rows(filePath, chunksize=DEFAULT_CHUNKSIZE):
+    wanted = REQUIRED_COLUMNS + OPTIONAL_COLUMNS
+    # every column is read as text, so each chunk parses the same way whatever its values look
+    # like (no per-chunk type inference turning numeric titles into floats); blank cells are ''
+    reader = pd.read_csv(filePath, usecols=lambda column: column in wanted, chunksize=chunksize,
+                         dtype=str, keep_default_na=False)
+    row_number = 0
+    for chunk in reader:
+        missing = [column for column in REQUIRED_COLUMNS if column not in chunk.columns]
+        if missing:
+            raise ValueError(f"CSV file is missing required column(s): {', '.join(missing)}")
+        for column in OPTIONAL_COLUMNS:
+            if column not in chunk.columns:
+                chunk[column] = None
+        chunk = chunk[wanted]
+
+        for row in chunk.itertuples(index=False, name=None):
+            row_number += 1
+            yield (row_number,) + tuple(None if value == "" or pd.isna(value) else value for value in row)
+
+
+# normalized (title, author) used to spot the same book across files: casefolded,
+# punctuation-insensitive, whitespace collapsed
+def normalize_key_part(text):
+    return " ".join(re.findall(r"[^\W_]+", str(text).casefold()))
+
+# stable 128-bit hash of a book's normalized (title, author)
+def book_key(title, author):
+    normalized = normalize_key_part(title) + "\x1f" + normalize_key_part(author)
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+
+
+# worker for Library.ingest_many (runs in a separate process): parses one file and returns
+# (filePath, rows, errors, duplicates) where rows are (key, title, author, genre, subgenre)
+# with duplicates inside the file already dropped (and counted), and errors are (row_number, message)
+def parse_catalog_file(filePath, chunksize=DEFAULT_CHUNKSIZE):
+    rows = []
+    errors = []
+    duplicates = 0
+    seen = set()
+    try:
+        for row_number, title, author, genre, subgenre in iter_csv_rows(filePath, chunksize):
+            if title is None or author is None or genre is None:
+                errors.append((row_number, "missing Title, Author or Genre"))
+                continue
+            key = book_key(title, author)
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            rows.append((key, str(title), str(author), str(genre), None if subgenre is None else str(subgenre)))
+    except Exception as e:
+        errors.append((0, f"failed to read file: {e}"))
+    return filePath, rows, errors, duplicates
@@ -8,162 +8,360 @@ Created on Wed Nov  5 16:17:45 2025
 @author: alexmessier
 """
 import sys
+import threading
+import multiprocessing
 from pathlib import Path
+from contextlib import contextmanager, ExitStack
 from datetime import timedelta
 from datetime import date
 import pandas as pd
-from auth.access_control import AccessControl # Assuming this is available
-from models.book import Book
+from auth.access_control import AccessControl, requires_permission # Assuming this is available
+from models.book import Book, CopyView
+from models.user import User
+from models.catalog_index import CatalogIndex
+from models.csv_ingest import iter_csv_rows, DEFAULT_CHUNKSIZE, book_key, parse_catalog_file
+from models.catalog_export import export_records
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from models.loan_table import LoanTable
+from models.change_tracker import ChangeTracker
+from models.locks import SharedExclusiveLock, StripedLocks
+
+
+# a circulation request the library refuses (nothing to pick up, already on hold, added to a
+# waitlist, not checked out); the message is meant for the user
+class CirculationError(Exception):
+    pass
 
 
 class Library:
     
+    # bumped whenever a derived structure (indexes, free-lists, ...) changes layout,
+    # so states saved by an older version get rebuilt on load
+    INDEX_VERSION = 7
+    
+    LATE_FEE_PER_DAY = 0.25 # charged per day a copy is overdue
+    
     def __init__(self, access_control=None):
         self.inventory = []
         self.current_date = date.today()
         self.default_checkout_window = 7 # days
         self.user_id_counter = 0 
+        self.catalog_index = CatalogIndex() # token -> books, per search field
+        self.loans = LoanTable() # every checked-out copy, column-wise (book, slot, borrower, due date)
+        self.index_version = Library.INDEX_VERSION
+        self.books_by_id = {} # book_id -> Book
+        self.book_keys = {} # hash of normalized (title, author) -> Book, for deduplication
+        self.next_book_id = 1
+        self.journal = None # persistence journal (see journal.py), attached by load_state
+        self.journal_seq = 0 # sequence number of the last journaled operation
+        self.changes = ChangeTracker() # what changed since the last save (incremental snapshots)
+        self.snapshot_seq = 0 # sequence number of the last snapshot (base or segment) saved
+        self.__create_locks()
         
         if access_control is None:
              self.ac = AccessControl()
         else:
              self.ac = access_control
         
+    # the journal holds an open file, so it is never pickled with the library
+    # (nor are the pending changes, which a saved state already contains, or the locks)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['journal'] = None
+        for name in ('changes', 'lock', 'item_locks', 'journal_lock'):
+            state.pop(name, None)
+        return state
+    
+    def __setstate__(self, state):
+        # libraries saved before journaling existed
+        state.setdefault('books_by_id', {})
+        state.setdefault('book_keys', {})
+        state.setdefault('next_book_id', 1)
+        state.setdefault('journal', None)
+        state.setdefault('journal_seq', 0)
+        state.setdefault('snapshot_seq', 0)
+        self.__dict__.update(state)
+        self.changes = ChangeTracker()
+        self.__create_locks()
+    
+    # Locking (see models/locks.py), always taken in this order:
+    #   lock (shared or exclusive) -> book locks -> user locks -> journal_lock -> loans.lock
+    # Circulation operations hold the library lock shared plus the locks of the books and
+    # users they change, so checkouts of different books run in parallel. A book's lock
+    # also guards the holds users have on it (their holds_pending / items_on_hold entries
+    # for that book). Catalog and library-wide changes, and snapshot captures, hold the
+    # library lock exclusively
+    def __create_locks(self):
+        self.lock = SharedExclusiveLock()
+        self.item_locks = StripedLocks()
+        self.journal_lock = threading.Lock() # journal sequence numbers and records
+    
+    # wraps a mutation: the journal (or storage backend), if one is attached, records the
+    # operation before it runs and is told once it has been applied, even if it raised
+    # (with the users it changed, lock_users, so a backend stores those very objects).
+    # With lock_books / lock_users the operation runs holding the library lock shared and the
+    # locks of those books and users; without, it holds the library lock exclusively.
+    # Either way a background save never sees half an operation
+    @contextmanager
+    def _journaled(self, op, lock_books=(), lock_users=(), **args):
+        # operations that take the library lock themselves checkpoint before taking it
+        if not self.lock.held_exclusively():
+            self._checkpoint_if_due()
+        
+        with ExitStack() as stack:
+            if lock_books or lock_users:
+                stack.enter_context(self.lock.shared())
+                stack.enter_context(self.item_locks.holding(lock_books, lock_users))
+            else:
+                stack.enter_context(self.lock)
+            
+            with self.journal_lock:
+                self.changes.mutations += 1
+                journal = self.journal
+                if journal is not None:
+                    seq = self.journal_seq + 1
+                    journal.append(seq, op, args)
+                    self.journal_seq = seq
+            if journal is None:
+                yield
+                return
+            try:
+                yield
+            finally:
+                with self.journal_lock:
+                    journal.applied(seq, op, args, users=lock_users)
+    
+    # a due journal checkpoint saves the whole state, so it must run before the caller holds
+    # any lock (with the library lock held, every other operation would wait for the save)
+    def _checkpoint_if_due(self):
+        journal = self.journal
+        if journal is not None and hasattr(journal, 'checkpoint_if_due'):
+            journal.checkpoint_if_due()
+    
+    # gives a book a stable ID and adds it to the search indexes
+    def __register_book(self, book):
+        if getattr(book, 'book_id', None) is None:
+            book.book_id = self.next_book_id
+        # a book that already has an ID (eg. a replayed add) must not get it handed out again
+        self.next_book_id = max(self.next_book_id, book.book_id + 1)
+        self.books_by_id[book.book_id] = book
+        self.book_keys.setdefault(book_key(book.name, book.author), book)
+        self.catalog_index.add(book)
+    
+    # creates a user with the next EECE ID, assigns their roles and adds them to userbase
+    def register_user(self, userbase, user_name, roles):
+        self._checkpoint_if_due()
+        # IDs are handed out under the library lock (exclusive)
+        with self.lock:
+            new_user_id = f"EECE{self.user_id_counter + 1:04d}"
+        
+            with self._journaled("register_user", user_id=new_user_id, username=user_name,
+                                 roles=[{"name": role.name, "permissions": sorted(role.permissions)} for role in roles]):
+                self.user_id_counter += 1
+                new_user_obj = User(user_name)
+                new_user_obj.user_id = new_user_id
+                userbase[new_user_id] = new_user_obj
+                self.ac.assign_role(new_user_obj.username, list(roles))
+                self.changes.mark_user(new_user_obj)
+                self.changes.mark_roles(new_user_obj.username)
+        
+        return new_user_id, new_user_obj
+        
     
+    @requires_permission("list_inv")
     def listInv(self,user):
-        # authorization check
-        if not self.ac.has_permission(user.username,"list_inv"):
-            raise PermissionError("Access Denied: list_inv")
         counter = 1
         for book in self.inventory:
             print(f"{counter}.",book)
             counter+=1
    
-    # bulk add books to inventory from a book dataset (CSV format)
-    def parse_CSV(self,filePath):
+    # bulk add books to inventory from a book dataset (CSV format). The file is streamed in
+    # chunks of chunksize rows, building books and index entries as it goes, so peak memory
+    # does not depend on the file size. on_progress(rows_read, books_added) is called after
+    # each chunk, and on_error(row_number, row, error) for each row that is skipped
+    def parse_CSV(self,filePath,chunksize=DEFAULT_CHUNKSIZE,on_progress=None,on_error=None):
         books_added = 0 
+        rows_read = 0
         try:
             print(f"[DEBUG] Attempting to load CSV from: {filePath}")
-            df = pd.read_csv(filePath,usecols=['Title','Author','Genre']).dropna()
-            
-            print(f"[DEBUG] CSV read successful. Found {len(df)} rows.")
-            
-            data = df.to_numpy()
             
-            for row in data:
-                title = row[0]
-                author = row[1]
-                genre = row[2]
+            # distinct values are sorted into the completion index once, at the end
+            with self.catalog_index.bulk():
+                for row in iter_csv_rows(filePath, chunksize):
+                    row_number, title, author, genre, subgenre = row
+                    rows_read = row_number
                 
-                try:
-                    self.inventory.append(Book(title,author,genre))
-                    books_added += 1
-                except Exception as book_err:
-                    print(f"[ERROR] Failed to instantiate Book for: {title} by {author}. Error: {book_err}. Skipping this row.")
-                    # Continue to try next row if only a few fail
-                    pass 
-
+                    if title is None or author is None or genre is None:
+                        # rows missing a required field are skipped (as dropna() did)
+                        if on_error is not None:
+                            on_error(row_number, row, ValueError("missing Title, Author or Genre"))
+                    else:
+                        try:
+                            book = Book(title,author,genre,subgenre)
+                            self.inventory.append(book)
+                            self.__register_book(book)
+                            books_added += 1
+                        except Exception as book_err:
+                            if on_error is not None:
+                                on_error(row_number, row, book_err)
+                            else:
+                                print(f"[ERROR] Failed to instantiate Book for: {title} by {author}. Error: {book_err}. Skipping this row.")
+                            # Continue to try next row if only a few fail
+                
+                    if on_progress is not None and row_number % chunksize == 0:
+                        on_progress(rows_read, books_added)
             
+            if on_progress is not None and rows_read % chunksize != 0:
+                on_progress(rows_read, books_added)
+            print(f"[DEBUG] CSV read successful. Read {rows_read} rows.")
             print(f"[DEBUG] Parsed CSV and added {books_added} items to inventory.")
             return books_added
         
         except FileNotFoundError:
             # Added specific print for File Not Found
             print(f"[ERROR] Failed to load CSV file. File not found at {filePath}.")
-            return 0
+            return books_added
         except Exception as e:
             print(f"[ERROR] Failed to load or process CSV file.") 
             print(f"[ERROR] The exact error is: {e}")
-            return 0
+            return books_added
     
-    def __find_available_copy(self,book):
-        for copy in book.copies:
-            if copy["borrowed_by"] is None:
-                return copy
-        return None 
+    # ingests many catalog files at once, parsing them in a pool of `workers` processes.
+    # Workers normalize and hash each (title, author); the results are then merged into the
+    # inventory in one pass, skipping books already in the library or seen in an earlier file.
+    # Returns a summary: {"files", "rows", "added", "duplicates", "errors"}
+    def ingest_many(self, paths, workers=None):
+        paths = [str(path) for path in paths]
+        summary = {"files": len(paths), "rows": 0, "added": 0, "duplicates": 0, "errors": []}
+        
+        # files are parsed without holding the library lock, so circulation carries on meanwhile
+        if workers == 1 or len(paths) <= 1:
+            parsed = list(map(parse_catalog_file, paths))
+        else:
+            # spawned, not forked: forking copies this process's held locks (eg. another thread's
+            # library or journal lock) into workers
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                # map() yields in file order, so the merge is deterministic
+                parsed = list(pool.map(parse_catalog_file, paths))
+        
+        rows = []
+        for filePath, file_rows, errors, duplicates in parsed:
+            summary["errors"].extend((filePath, row_number, message) for row_number, message in errors)
+            summary["rows"] += len(file_rows) + duplicates
+            summary["duplicates"] += duplicates
+            rows.extend(file_rows)
+        added, duplicates = self.add_catalog_rows(rows)
+        summary["added"] += added
+        summary["duplicates"] += duplicates
+        
+        print(f"[DEBUG] Ingested {summary['files']} file(s): {summary['added']} books added, "
+              f"{summary['duplicates']} duplicates skipped, {len(summary['errors'])} errors.")
+        return summary
     
-    def __process_checkout(self, user, book, copy):
-        today = self.current_date
-        copy["borrowed_by"] = user
-        copy["borrow_date"] = today
-        copy["return_date"] = today + timedelta(days=self.default_checkout_window)
-        user.items_checked_out.append((book, copy))
-
-    def checkout_item(self, book, user):
-        pass 
-
-
-    def return_item(self, book, user):
-        pass
-
+    # adds parsed catalog rows (key, title, author, genre, subgenre), see parse_catalog_file,
+    # skipping books already in the library or earlier in rows. The added books are journaled
+    # themselves, so replaying the journal does not depend on the source files.
+    # Returns (added, duplicates)
+    def add_catalog_rows(self, rows):
+        self._checkpoint_if_due()
+        # the catalog changes, so the library lock is held exclusively
+        with self.lock:
+            new_rows = []
+            seen = set()
+            for key, title, author, genre, subgenre in rows:
+                if key in self.book_keys or key in seen:
+                    continue
+                seen.add(key)
+                new_rows.append([title, author, genre, subgenre])
+            if new_rows:
+                with self._journaled("ingest_many", first_book_id=self.next_book_id, books=new_rows), \
+                        self.catalog_index.bulk():
+                    for title, author, genre, subgenre in new_rows:
+                        book = Book(title, author, genre, subgenre)
+                        self.inventory.append(book)
+                        self.__register_book(book)
+                        self.changes.mark_book(book)
+        return len(new_rows), len(rows) - len(new_rows)
+    
+    @requires_permission("delete_user", user_arg="admin_user")
     def cleanup_user_data(self, user_obj, admin_user):
-        # Authorization check
-        if not self.ac.has_permission(admin_user.username, "delete_user"):
-            raise PermissionError("Access Denied: delete_user")
-
-        # Handle checked-out items (reset copies and advance waitlist)
-        for book_ref, copy_ref in list(user_obj.items_checked_out):
-            # Reset the specific copy back to available
-            copy_ref["borrowed_by"] = None
-            copy_ref["borrow_date"] = None
-            copy_ref["return_date"] = None
-            
-            # Advance waitlist for that book as if it was returned
-            if len(book_ref.waitlist.queue) > 0:
-                book_ref.waitlist.advance_waitlist()
-        
-        # Handle waitlist items (remove user from queues/holds)
-        for book in self.inventory:
-            # Remove from waitlist queue (deque method)
-            if user_obj in book.waitlist.queue:
-                book.waitlist.queue.remove(user_obj)
+        self._checkpoint_if_due()
+        with self.lock:
+            # every book the user touches, so storage backends know which rows change
+            book_ids = [b.book_id for b, c in user_obj.items_checked_out] + [b.book_id for b in user_obj.items_on_hold]
+            with self._journaled("cleanup_user", user_id=user_obj.user_id, admin_id=admin_user.user_id, book_ids=book_ids):
+                # Handle checked-out items (reset copies and advance waitlist)
+                for book_ref, copy_ref in list(user_obj.items_checked_out):
+                    # Reset the specific copy back to available
+                    self.__clear_checkout(book_ref, copy_ref)
+                
+                    # Advance waitlist for that book as if it was returned
+                    if book_ref.has_waitlist() and len(book_ref.waitlist) > 0:
+                        book_ref.waitlist.advance_waitlist(self.current_date)
             
-            # Remove from holds_pending set
-            holds_to_remove = set()
-            for hold in book.waitlist.holds_pending:
-                if hold[0] == user_obj:
-                    holds_to_remove.add(hold)
-            book.waitlist.holds_pending -= holds_to_remove
+                # Handle waitlist items (remove user from queues/holds). Only the books
+                # the user is waitlisted for or holding are visited
+                for book in list(user_obj.items_on_hold):
+                    book.waitlist.remove(user_obj)
+                    book.drop_empty_waitlist()
+                    self.changes.mark_book(book)
+                user_obj.items_on_hold.clear()
 
-        # Clean up AccessControl roles
-        if user_obj.username in self.ac.user_roles:
-            del self.ac.user_roles[user_obj.username]
+                # Clean up AccessControl roles
+                if self.ac.revoke_roles(user_obj.username):
+                    self.changes.mark_roles(user_obj.username)
             
         return f"Cleaned up {len(user_obj.items_checked_out)}"
     
     # PERSISTENCE METHODS
     
-    def catalog_system(self, user, list_of_users):
-        if not self.ac.has_permission(user.username,"catalog_system"):
-            raise PermissionError("Access Denied: catalog_system")
-        master_list_catalog = []
+    # one record per checked-out copy, waitlist entry and hold waiting to be picked up, for each
+    # user in list_of_users. Records are dicts with the CATALOG_FIELDS keys (status is
+    # "checked_out", "waitlist" or "hold") and are produced one at a time
+    @requires_permission("catalog_system")
+    def iter_catalog(self, user, list_of_users):
         if list_of_users is None:
             print("No users yet.")
-            return master_list_catalog 
-            
+            return iter(())
+        return self.__catalog_records(list_of_users)
+    
+    def __catalog_records(self, list_of_users):
         for user in list_of_users:
-            if user.items_checked_out: 
-                for book, copy in user.items_checked_out: 
-                    record = {
-                        "username": user.username,
-                        "book_title": book.name,
-                        "return_date": copy["return_date"]
-                    }
-                    master_list_catalog.append(record)
-        return master_list_catalog
-        
-    def save_state(self, user, master_catalog_list):
-        # authorization check
-        if not self.ac.has_permission(user.username,"save_state"):
-            raise PermissionError("Access Denied: save_state")
-            
-        output_filename = "catalogSystem.csv"
-        master_catalog_df = pd.DataFrame(master_catalog_list)
-        if len(master_catalog_df) > 0:
-            master_catalog_df.to_csv(output_filename, index=False)
-            print(f"\nSuccessfully saved {len(master_catalog_df)} records to {output_filename}.")
-        else:
+            for book, copy in user.items_checked_out:
+                yield {"username": user.username, "user_id": user.user_id, "book_id": book.book_id,
+                       "book_title": book.name, "status": "checked_out", "borrow_date": copy["borrow_date"],
+                       "return_date": copy["return_date"], "position": None, "pickup_by": None}
+            for book in user.items_on_hold:
+                pickup_by = user.holds_pending.get(book)
+                if pickup_by is not None:
+                    status, position = "hold", None
+                else:
+                    status, position = "waitlist", book.waitlist.get_pos(user)
+                yield {"username": user.username, "user_id": user.user_id, "book_id": book.book_id,
+                       "book_title": book.name, "status": status, "borrow_date": None,
+                       "return_date": None, "position": position, "pickup_by": pickup_by}
+    
+    def catalog_system(self, user, list_of_users):
+        return list(self.iter_catalog(user, list_of_users))
+        
+    # writes catalog records (a list, or the generator from iter_catalog) to output_filename as
+    # they come, as CSV or, by extension (.parquet / .arrow), a columnar file (needs pyarrow).
+    # Returns the number of records written
+    @requires_permission("save_state")
+    def save_state(self, user, master_catalog_list, output_filename="catalogSystem.csv"):
+        records = iter(master_catalog_list)
+        first = next(records, None)
+        if first is None:
             print("\nNo checked out items to save.")
+            return 0
+        count = export_records(chain([first], records), output_filename)
+        print(f"\nSuccessfully saved {count} records to {output_filename}.")
+        return count
+    
+    # streams the catalog of list_of_users straight to a file (see save_state)
+    def export_catalog(self, user, list_of_users, output_filename="catalogSystem.csv"):
+        return self.save_state(user, self.iter_catalog(user, list_of_users), output_filename)
 
     # fetches the save-file (CSV) from storage and returns the data as a Pandas dataframe
     @staticmethod
@@ -188,33 +386,41 @@ class Library:
 
           
     # Checks out a book from the library's inventory. 
+    @requires_permission("checkout_item")
     def checkout_item(self, book, user):
+        # journaled before anything changes; a failed checkout fails the same way on replay
+        with self._journaled("checkout", lock_books=[book], lock_users=[user], book_id=book.book_id, user_id=user.user_id):
+            return self.__checkout(book, user)
     
-    # Permission check
-        if not self.ac.has_permission(user.username, "checkout_item"):
-            raise PermissionError("Access Denied: checkout_item")
-    
+    def __checkout(self, book, user):
     # Define concise history update function
         def _update_history(book, user):
             genre_name = book.genre.strip()
             user.checkout_history[genre_name] = user.checkout_history.get(genre_name, 0) + 1
+            self.changes.mark_user(user)
     
-        # Check for Hold/Waitlist Pickup
+        # Check for Hold/Waitlist Pickup (the user's own hold index, no scan of the waitlist)
         if book in user.items_on_hold:
-            for u, window in book.waitlist.holds_pending:
-                if u == user:
-                    copy = self.__find_available_copy(book)
-                    self.__process_checkout(user, book, copy)
+            if book.waitlist.has_pending_hold(user):
+                copy = book.acquire_copy()
+                if copy is None:
+                    raise CirculationError(f"No copy of {book.name} is available for pickup yet.")
+                self.__process_checkout(user, book, copy)
+                
+                # the hold has been picked up
+                book.waitlist.remove(user)
+                book.drop_empty_waitlist()
+                user.items_on_hold.remove(book)
                 
-                    _update_history(book, user) 
+                _update_history(book, user) 
                 
-                    return f"Checkout successful (Hold): {book.name}"
+                return f"Checkout successful (Hold): {book.name}"
         
             # User is on hold but not currently in the pending pickup window
-            raise Exception(f"{book.name} is already on hold (position: {book.waitlist.get_pos(user)})")
+            raise CirculationError(f"{book.name} is already on hold (position: {book.waitlist.get_pos(user)})")
         
-        # Check for immediate availability
-        copy = self.__find_available_copy(book)
+        # Check for immediate availability (takes a copy off the book's free-list)
+        copy = book.acquire_copy()
         if copy is not None:
             self.__process_checkout(user, book, copy)
             
@@ -227,15 +433,17 @@ class Library:
         
         pos = book.waitlist.add_to_queue(user)
         user.items_on_hold.append(book)
-        raise Exception(f"All copies checked out. Added to waitlist (position: {pos})")
+        self.changes.mark_book(book)
+        raise CirculationError(f"All copies checked out. Added to waitlist (position: {pos})")
         
         
-        # Returns a book to the library's inventory, and assesses late fees if applicable
+    # Returns a book to the library's inventory, and assesses late fees if applicable
+    @requires_permission("return_item")
     def return_item(self,book,user):
-        # check authorization
-        if not self.ac.has_permission(user.username,"return_item"):
-            raise PermissionError("Denied access: return_item")
+        with self._journaled("return", lock_books=[book], lock_users=[user], book_id=book.book_id, user_id=user.user_id):
+            return self.__return(book, user)
         
+    def __return(self,book,user):
         # check if the user actually has the book checked out
         copy = None
         for b,c in user.items_checked_out:
@@ -243,138 +451,215 @@ class Library:
                 copy = c
         if copy == None:
             # print(f"{user} does not currently have {book.name} checked out.") # Removed print for UI
-            raise Exception(f"{book.name} is NOT checked out by you.")
+            raise CirculationError(f"{book.name} is NOT checked out by you.")
             
         
         # clear the update the copy information on the book
-        copy["borrowed_by"] = None
-        copy["borrow_date"] = None
-        copy["return_date"] = None
+        self.__clear_checkout(book, copy)
         
-        # remove the book from user's items_checked_out list
+        # remove the book from user's items_checked_out list (the entry for the copy just cleared)
         for b,c in user.items_checked_out:
-            if b == book:
+            if b == book and c is copy:
                 user.items_checked_out.remove((b,c))
                 break
         
         
-        # advance the waitlist
-        book.waitlist.advance_waitlist()    
+        # advance the waitlist (if anyone is waiting)
+        if book.has_waitlist():
+            book.waitlist.advance_waitlist(self.current_date)
+            book.drop_empty_waitlist()
         return f"Return successful: {book.name}"
         
+    # Batch circulation: items is a list of (book, user) pairs. Permission is checked once per
+    # user, and the whole batch holds its books' and users' locks once. Returns one result per
+    # item, in order: {"book", "user", "ok" (bool), "message"}. A refused item (no permission,
+    # nothing to return, added to a waitlist...) does not stop the rest of the batch
+    def checkout_many(self, items):
+        items, results, allowed = self.__prepare_batch(items, "checkout_item", "Access Denied: checkout_item")
+        if not items:
+            return results
+        with self._journaled("checkout_many", lock_books=[book for book, user in items],
+                             lock_users=[user for book, user in items], items=self.__batch_ids(items)):
+            for i, (book, user) in enumerate(items):
+                if not allowed[user]:
+                    continue
+                try:
+                    results[i].update(ok=True, message=self.__checkout(book, user))
+                except Exception as e:
+                    results[i]["message"] = str(e)
+        return results
+
+    # returns every item in one pass: each user's checked-out list is indexed by book once and
+    # rebuilt once, and each book's waitlist is advanced once per copy returned, after its returns
+    def return_many(self, items):
+        items, results, allowed = self.__prepare_batch(items, "return_item", "Access Denied: return_item")
+        if not items:
+            return results
+        with self._journaled("return_many", lock_books=[book for book, user in items],
+                             lock_users=[user for book, user in items], items=self.__batch_ids(items)):
+            loans_by_user = {} # user -> {book: [checked-out entries still to return, in list order]}
+            returned = {} # user -> ids of the entries returned
+            copies_returned = {} # book -> number of copies returned
+            for i, (book, user) in enumerate(items):
+                if not allowed[user]:
+                    continue
+                loans = loans_by_user.get(user)
+                if loans is None:
+                    loans = loans_by_user[user] = {}
+                    for entry in user.items_checked_out:
+                        loans.setdefault(entry[0], []).append(entry)
+                    returned[user] = set()
+                # the last copy of the book in the list, as return_item picks
+                entries = loans.get(book)
+                if not entries:
+                    results[i]["message"] = f"{book.name} is NOT checked out by you."
+                    continue
+                entry = entries.pop()
+                self.__clear_checkout(book, entry[1])
+                returned[user].add(id(entry))
+                copies_returned[book] = copies_returned.get(book, 0) + 1
+                results[i].update(ok=True, message=f"Return successful: {book.name}")
+
+            for user, ids in returned.items():
+                if ids:
+                    user.items_checked_out = [entry for entry in user.items_checked_out if id(entry) not in ids]
+            for book, count in copies_returned.items():
+                if book.has_waitlist():
+                    for _ in range(count):
+                        book.waitlist.advance_waitlist(self.current_date)
+                    book.drop_empty_waitlist()
+        return results
+
+    # checks the batch's items and each user's permission (once per user). Returns
+    # (items as a list, results with ok False, {user: allowed})
+    def __prepare_batch(self, items, permission, denied_message):
+        items = list(items)
+        results = []
+        allowed = {}
+        for book, user in items:
+            if not isinstance(book, Book):
+                raise TypeError
+            if user not in allowed:
+                allowed[user] = bool(self.ac.has_permission(user.username, permission))
+            results.append({"book": book, "user": user, "ok": False,
+                            "message": None if allowed[user] else denied_message})
+        return items, results, allowed
+
+    @staticmethod
+    def __batch_ids(items):
+        return [[book.book_id, user.user_id] for book, user in items]
+        
 #================================================================  
 # ADMIN ACCESSIBLE METHODS  
 
     # remove a book from the library's inventory
+    @requires_permission("remove_item")
     def remove_item(self,book,user):
-        # authorization check
-        if not self.ac.has_permission(user.username,"remove_item"):
-            raise PermissionError("Access Denied: remove_item")
-        
         if not isinstance(book,Book): raise TypeError
         
-        # search for book in library inventory. If found, remove it and return True
-        if book in self.inventory:
-            self.inventory.remove(book)
-            return True
-        else: return False
+        self._checkpoint_if_due()
+        with self.lock:
+            # search for book in library inventory. If found, remove it and return True
+            if book in self.inventory:
+                with self._journaled("remove_item", book_id=book.book_id, user_id=user.user_id):
+                    self.inventory.remove(book)
+                    self.catalog_index.remove(book)
+                    self.books_by_id.pop(book.book_id, None)
+                    key = book_key(book.name, book.author)
+                    if self.book_keys.get(key) is book:
+                        del self.book_keys[key]
+                    self.changes.mark_removed(book)
+                return True
+            else: return False
     
     # add a book to the library's inventory
+    @requires_permission("add_item")
     def add_item(self,book,user):
-        # authorization check
-        if not self.ac.has_permission(user.username,"add_item"):
-            raise PermissionError("Access Denied: add_item")
-            
         if not isinstance(book,Book): raise TypeError
         
-        # search for book in library inventory. If not found, add it and return True
-        if book not in self.inventory:
-            self.inventory.append(book)
-            return True
-        else: return False
+        self._checkpoint_if_due()
+        with self.lock:
+            # search for book in library inventory. If not found, add it and return True
+            if book not in self.inventory:
+                book_id = book.book_id if book.book_id is not None else self.next_book_id
+                with self._journaled("add_item", book_id=book_id, title=book.name, author=book.author, genre=book.genre,
+                                     subgenre=getattr(book, 'subgenre', None), user_id=user.user_id):
+                    self.inventory.append(book)
+                    self.__register_book(book)
+                    self.changes.mark_book(book)
+                return True
+            else: return False
 
 
-    # searches for an available copy of a book. if none found, returns None
-    def __find_available_copy(self,book):
-        counter = 0
-        while counter < len(book.copies):
-            if book.copies[counter]["borrowed_by"] == None:
-                return book.copies[counter]
-            counter+=1
-        return None
-      
     # tags a book copy with the appropriate information when it is checked out and adds it to the user's checked-out inventory
     def __process_checkout(self,user,book,copy):   
-        copy["borrowed_by"] = user
         today = self.current_date
-        copy["borrow_date"] = today
-        copy["return_date"] = today + timedelta(days=self.default_checkout_window)
+        return_date = today + timedelta(days=self.default_checkout_window)
+        book.set_copy(copy["slot"], user, today, return_date)
         user.items_checked_out.append((book,copy))
+        self.loans.add(book, copy["slot"], user, return_date)
+        self.changes.mark_book(book)
     
+    # clears a copy's checkout information and puts it back on the shelf
+    def __clear_checkout(self,book,copy):
+        self.loans.remove(book, copy["slot"])
+        book.set_copy(copy["slot"], None, None, None)
+        book.release_copy(copy)
+        self.changes.mark_book(book)
     
+    
+    @requires_permission("check_overdue")
     def check_overdue(self,user):
-        # authorization check
-        if not self.ac.has_permission(user.username,"check_overdue"):
-            raise PermissionError("Access Denied: check_overdue")
-            
-        overdue_list = []
-        for book in self.inventory:
-            overdue = self.__get_overdue_copies(book)
-            for copy in overdue:
-                overdue_list.append(copy)
-        return overdue_list
-         
-    # checks a book object for checked-out copies which are overdue
-    # returns a list of overdue copies
-    def __get_overdue_copies(self,book):
-        
-        if not isinstance(book,Book):
-            raise TypeError
-        
-        overdue_copies = []
-        for copy in book.copies:
-            # see if copy is checked out
-            if copy["borrowed_by"]!=None:
-                # Use strict inequality for 'overdue' to align with UI logic
-                if copy["return_date"] < self.current_date: 
-                    overdue_copies.append(copy)
-        return overdue_copies
-
-
-    def __get_days_overdue(self,copy):
-        return_date = copy["return_date"]
-        time_delta = self.current_date - return_date
-        days_overdue = time_delta.days
-        return days_overdue
+        # overdue loans and their days overdue are computed over the whole loan table at
+        # once; only the overdue rows become records
+        loans = self.loans
+        with self.lock.shared(), loans.lock:
+            rows = loans.overdue_rows(self.current_date)
+            days_overdue = loans.days_overdue(self.current_date)[rows]
+            overdue_list = []
+            for row, days in zip(rows.tolist(), days_overdue.tolist()):
+                book = loans.books[row]
+                slot = int(loans.slots[row])
+                copy = book.get_copy(slot)
+                record = {
+                    "book": book,
+                    "copy_index": slot,
+                    "copy": copy,
+                    "borrower": loans.users[loans.borrowers[row]],
+                    "return_date": date.fromordinal(int(loans.due[row])),
+                    "days_overdue": days
+                }
+                overdue_list.append(record)
+            return overdue_list
     
+    # circulation totals at the library's current date: {"loans", "overdue", "outstanding"
+    # (User -> copies out), "overdue_by_user" (User -> overdue copies), "late_fees" (User -> amount owed)}
+    @requires_permission("check_overdue")
+    def loan_summary(self,user):
+        with self.lock.shared(), self.loans.lock:
+            overdue_by_user = self.loans.overdue_counts(self.current_date)
+            return {
+                "loans": len(self.loans),
+                "overdue": sum(overdue_by_user.values()),
+                "outstanding": self.loans.outstanding_counts(),
+                "overdue_by_user": overdue_by_user,
+                "late_fees": self.loans.late_fees(self.current_date, self.LATE_FEE_PER_DAY),
+            }
+         
     # modify the current date recognized by the library instance AND related classes
+    @requires_permission("set_date")
     def set_date(self,new_date,user):
-        # authorization check
-        if not self.ac.has_permission(user.username,"set_date"):
-            raise PermissionError("Access Denied: set_date")
-            
         if not isinstance(new_date,date):
             raise TypeError
-        self.current_date = new_date
+        with self._journaled("set_date", date=new_date.isoformat(), user_id=user.user_id):
+            self.current_date = new_date
 
 
     #search for books by title 
     def __search_by_substring(self, search_term, field):
-        """Helper for case-insensitive substring search."""
-        results = []
-        term_lower = search_term.lower()
-        
-        for book in self.inventory:
-            try:
-                if field == 'title' and term_lower in book.name.lower():
-                    results.append(book)
-                elif field == 'author' and term_lower in book.author.lower():
-                    results.append(book)
-                elif field == 'genre' and term_lower in book.genre.lower():
-                    results.append(book)
-            except AttributeError:
-                # Handles cases where the book object might be missing the attribute
-                continue 
+        """Helper for case-insensitive substring search (answered from the catalog index)."""
+        with self.lock.shared():
+            results = self.catalog_index.search(field, search_term, self.inventory)
                 
         if results: 
             # Output for console/terminal
@@ -395,22 +680,89 @@ class Library:
     #searches for book by the genre, returns a list of books with that genre
     def search_by_genre(self,genre):
         return self.__search_by_substring(genre, 'genre')
+
+    #searches for book by the subgenre (eg. 'data_science')
+    def search_by_subgenre(self,subgenre):
+        return self.__search_by_substring(subgenre, 'subgenre')
+
+    # compound search across fields, eg. query("author=Foreman AND genre=tech") or
+    # query({'author': 'Foreman', 'genre': 'tech'}). Raises ValueError for a malformed query
+    def query(self, criteria, limit=None, offset=0, available_only=False):
+        if isinstance(criteria, str):
+            predicates = self.catalog_index.parse_query(criteria)
+        elif isinstance(criteria, dict):
+            predicates = [(field.lower(), term) for field, term in criteria.items()]
+        else:
+            predicates = [(field.lower(), term) for field, term in criteria]
+            
+        with self.lock.shared():
+            results = self.catalog_index.query(predicates)
+        if available_only:
+            results = [book for book in results if book.has_available_copy()]
+        print(f"\n{len(results)} found for query {predicates}.")
+        if limit is None:
+            return results[offset:]
+        return results[offset:offset + limit]
     
-    def search_catalog(self, search_term, search_by):
+    # relevance-ranked search across title/author/genre (BM25), one page at a time.
+    # with_scores returns (score, book) pairs, eg. to merge the results of several shards
+    def search_ranked(self, search_term, fields=None, limit=20, offset=0, available_only=False, with_scores=False):
+        book_filter = Book.has_available_copy if available_only else None
+        with self.lock.shared():
+            ranked = self.catalog_index.rank(search_term, fields, limit, offset, book_filter)
+        print(f"\n{len(ranked)} ranked results for '{search_term}' (offset {offset}).")
+        if with_scores:
+            return ranked
+        return [book for score, book in ranked]
+    
+    def search_catalog(self, search_term, search_by, limit=None, offset=0, available_only=False):
         """
         Delegates search to the appropriate specific function based on search_by.
+        search_by 'relevance' ranks matches across all fields. limit/offset select
+        a page of the results (limit None returns every match), and available_only
+        keeps only books with a copy on the shelf.
         """
         search_by = search_by.lower()
-        if search_by == 'title':
-            return self.search_by_title(search_term)
+        if search_by == 'relevance':
+            return self.search_ranked(search_term, limit=20 if limit is None else limit, offset=offset,
+                                      available_only=available_only)
+        elif search_by == 'title':
+            results = self.search_by_title(search_term)
         elif search_by == 'author':
-            return self.search_by_author(search_term)
+            results = self.search_by_author(search_term)
         elif search_by == 'genre':
-            return self.search_by_genre(search_term)
+            results = self.search_by_genre(search_term)
+        elif search_by == 'subgenre':
+            results = self.search_by_subgenre(search_term)
         else:
             print(f"[ERROR] Invalid search category: {search_by}")
             return []
-        
+        if available_only:
+            results = [book for book in results if book.has_available_copy()]
+        if limit is None:
+            return results[offset:]
+        return results[offset:offset + limit]
+        
+    # lists a user's holds: books they are waitlisted for (with their position) and
+    # copies waiting for them to pick up (with the pickup deadline)
+    def get_user_holds(self, user):
+        holds = []
+        for book in user.items_on_hold:
+            pickup_by = user.holds_pending.get(book)
+            if pickup_by is not None:
+                holds.append({"book": book, "status": "ready", "position": None, "pickup_by": pickup_by})
+            else:
+                holds.append({"book": book, "status": "waitlist", "position": book.waitlist.get_pos(user), "pickup_by": None})
+        return holds
+    
+    # suggests up to limit titles/authors/genres starting with prefix, for search-as-you-type
+    def autocomplete(self, prefix, field='title', limit=10):
+        field = field.lower()
+        if not prefix:
+            return []
+        with self.lock.shared():
+            return self.catalog_index.complete(field, prefix, limit)
+
     def recommend_books(self, user, max_recommendations=5): 
         if not user.checkout_history:
             print(f"\n{user.username} has no checkout history. No recommendations available.")
@@ -438,3 +790,76 @@ class Library:
             print(f"No additional books are available in the '{favorite_genre}' genre.")
         
         return recommendations[:max_recommendations]
+
+    # rebuilds the search indexes from the inventory (eg. for states saved before indexing existed).
+    # catalog_index, if given, is a search index already built for exactly these books (eg. one
+    # stored with the catalog) and is used as is
+    def rebuild_indexes(self, catalog_index=None):
+        self.catalog_index = catalog_index if catalog_index is not None else CatalogIndex()
+        self.loans = LoanTable()
+        self.books_by_id = {}
+        self.book_keys = {}
+        with self.catalog_index.bulk():
+            self.__rebuild_book_indexes()
+        self.index_version = Library.INDEX_VERSION
+    
+    def __rebuild_book_indexes(self):
+        for book in self.inventory:
+            if not hasattr(book, 'subgenre'):
+                book.subgenre = None
+            if not hasattr(book, 'book_id'):
+                book.book_id = None
+            book.rebuild_availability()
+            self.__register_book(book)
+            for slot, borrower, return_date in book.checked_out_copies():
+                if return_date is not None:
+                    self.loans.add(book, slot, borrower, return_date)
+                # users saved when copies were dicts point at views of the copies instead
+                if any(not isinstance(copy, CopyView) for b, copy in borrower.items_checked_out):
+                    borrower.items_checked_out = [(b, copy if isinstance(copy, CopyView) else b.get_copy(copy["slot"]))
+                                                  for b, copy in borrower.items_checked_out]
+            # per-user hold index (users saved before it existed)
+            for holder, checkout_by in book.pending_holds():
+                if getattr(holder, 'holds_pending', None) is None:
+                    holder.holds_pending = {}
+                holder.holds_pending[book] = checkout_by
+
+    # brings the indexes up to date after the state of some books was replaced from outside
+    # (eg. merged from snapshot segments), without touching the other books: removed books
+    # leave every index, and changed or new books get their free-lists and loans recomputed
+    # (new ones are also indexed for search). Indexes due for a full rebuild are left alone
+    def reindex_books(self, changed=(), removed=()):
+        if self.__indexes_outdated():
+            return
+        for book in removed:
+            self.catalog_index.remove(book)
+            for slot in range(book.num_copies):
+                self.loans.remove(book, slot)
+            if self.books_by_id.get(book.book_id) is book:
+                del self.books_by_id[book.book_id]
+            key = book_key(book.name, book.author)
+            if self.book_keys.get(key) is book:
+                del self.book_keys[key]
+        with self.catalog_index.bulk():
+            for book in changed:
+                book.rebuild_availability()
+                for slot in range(book.num_copies):
+                    self.loans.remove(book, slot)
+                for slot, borrower, return_date in book.checked_out_copies():
+                    if return_date is not None:
+                        self.loans.add(book, slot, borrower, return_date)
+                if book not in self.catalog_index:
+                    self.__register_book(book)
+    
+    def __indexes_outdated(self):
+        index = getattr(self, 'catalog_index', None)
+        return (getattr(index, 'version', None) != CatalogIndex.VERSION
+                or getattr(self, 'index_version', None) != Library.INDEX_VERSION)
+    
+    # rebuilds the indexes only if they are missing or were saved by an older version
+    def ensure_indexes(self):
+        if self.__indexes_outdated():
+            self.rebuild_indexes()
+            # books may have been given new IDs, so the next save must be a full snapshot
+            self.changes.mark_all()
+
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import numpy as np
+
+
+class LoanTable:
+    """
+    Every checked-out copy, stored column-wise in NumPy arrays (struct of
+    arrays): book ID, copy slot, borrower code and due-date ordinal, one row
+    per loan. The Library adds a row when a copy is checked out and removes it
+    when the copy comes back (the last row is moved into the gap), so
+    questions about all loans at a given date -- which are overdue, by how
+    many days, how many each user has out, what they owe -- are single
+    vectorized expressions instead of loops over copies, however far the
+    library's date jumps. A borrower's code is released when their last loan
+    row goes, so the user columns stay as long as the current borrowers.
+
+    Checkouts of different books update the table concurrently, so every
+    method holds self.lock. Callers reading several results that must agree
+    (eg. rows and then the columns at those rows) hold it around all of them;
+    it is reentrant, and always the last lock taken.
+    """
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.book_ids = np.zeros(capacity, dtype=np.int64)
+        self.slots = np.zeros(capacity, dtype=np.int32)
+        self.borrowers = np.zeros(capacity, dtype=np.int32) # index into self.users
+        self.due = np.zeros(capacity, dtype=np.int32) # date.toordinal()
+        self.books = np.empty(capacity, dtype=object) # row -> Book, to hand results back
+        self.row_of = {} # (book, slot) -> row
+        self.users = [] # borrower code -> User (None: code free)
+        self.user_codes = {} # User -> borrower code
+        self.user_loans = [] # borrower code -> number of rows
+        self.free_codes = [] # released borrower codes, reused first
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        if 'user_loans' not in state:
+            # tables saved before codes were released: drop the users with no rows left
+            counts = np.bincount(self.borrowers[:self.count], minlength=len(self.users)).tolist()
+            self.user_loans = counts
+            self.free_codes = []
+            for code, n in enumerate(counts):
+                if not n and self.users[code] is not None:
+                    self.user_codes.pop(self.users[code], None)
+                    self.users[code] = None
+                    self.free_codes.append(code)
+
+    def __len__(self):
+        with self.lock:
+            return self.count
+
+    def __grow(self):
+        capacity = max(64, 2 * len(self.due))
+        for name in ("book_ids", "slots", "borrowers", "due", "books"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype) if old.dtype != object else np.empty(capacity, dtype=object)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    # the borrower code of user, taking one for them if they have no loans yet
+    def __take_code(self, user):
+        code = self.user_codes.get(user)
+        if code is None:
+            if self.free_codes:
+                code = self.free_codes.pop()
+                self.users[code] = user
+            else:
+                code = len(self.users)
+                self.users.append(user)
+                self.user_loans.append(0)
+            self.user_codes[user] = code
+        self.user_loans[code] += 1
+        return code
+
+    # one of the code's rows is gone; the code is freed with its last row
+    def __drop_code(self, code):
+        self.user_loans[code] -= 1
+        if not self.user_loans[code]:
+            del self.user_codes[self.users[code]]
+            self.users[code] = None
+            self.free_codes.append(code)
+
+    def add(self, book, slot, user, due_date):
+        with self.lock:
+            key = (book, slot)
+            row = self.row_of.get(key)
+            if row is None:
+                if self.count == len(self.due):
+                    self.__grow()
+                row = self.count
+                self.count += 1
+                self.row_of[key] = row
+            else:
+                self.__drop_code(int(self.borrowers[row]))
+            self.book_ids[row] = book.book_id if book.book_id is not None else -1
+            self.slots[row] = slot
+            self.borrowers[row] = self.__take_code(user)
+            self.due[row] = due_date.toordinal()
+            self.books[row] = book
+
+    def remove(self, book, slot):
+        with self.lock:
+            row = self.row_of.pop((book, slot), None)
+            if row is None:
+                return
+            self.__drop_code(int(self.borrowers[row]))
+            last = self.count - 1
+            if row != last:
+                # move the last row into the gap
+                for column in (self.book_ids, self.slots, self.borrowers, self.due, self.books):
+                    column[row] = column[last]
+                self.row_of[(self.books[row], int(self.slots[row]))] = row
+            self.books[last] = None
+            self.count = last
+
+    # =========================
+    # Vectorized queries (current_date is a datetime.date)
+    # =========================
+
+    # days each loan is overdue (negative: days left), in row order
+    def days_overdue(self, current_date):
+        with self.lock:
+            return current_date.toordinal() - self.due[:self.count]
+
+    # rows of the loans due strictly before current_date, earliest due first
+    def overdue_rows(self, current_date):
+        with self.lock:
+            due = self.due[:self.count]
+            rows = np.flatnonzero(due < current_date.toordinal())
+            return rows[np.argsort(due[rows], kind='stable')]
+
+    # {User: number of copies they have checked out}
+    def outstanding_counts(self):
+        with self.lock:
+            counts = np.bincount(self.borrowers[:self.count], minlength=len(self.users))
+            return {self.users[code]: int(n) for code, n in enumerate(counts) if n}
+
+    # {User: number of their copies that are overdue}
+    def overdue_counts(self, current_date):
+        with self.lock:
+            late = self.days_overdue(current_date) > 0
+            counts = np.bincount(self.borrowers[:self.count][late], minlength=len(self.users))
+            return {self.users[code]: int(n) for code, n in enumerate(counts) if n}
+
+    # {User: late fees owed at current_date}, fee_per_day for every day each copy is overdue
+    def late_fees(self, current_date, fee_per_day):
+        with self.lock:
+            days = np.maximum(self.days_overdue(current_date), 0)
+            fees = np.bincount(self.borrowers[:self.count], weights=days * fee_per_day, minlength=len(self.users))
+            return {self.users[code]: round(float(fee), 2) for code, fee in enumerate(fees) if fee > 0}
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+from contextlib import contextmanager, ExitStack
+
+
+class SharedExclusiveLock:
+    """
+    Readers-writer lock for the Library as a whole.
+
+    Circulation operations (which also lock the books and users they touch,
+    see StripedLocks) and searches hold it in shared mode, so they run side
+    by side. Operations that change the catalog or library-wide settings, and
+    snapshot captures, hold it in exclusive mode (`with lock:`). A waiting
+    exclusive holder goes first, so a stream of readers cannot starve it.
+
+    Both modes are reentrant for the thread holding them, and the exclusive
+    holder may also enter shared mode, but a shared holder must not ask for
+    exclusive mode.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None # thread ident of the exclusive holder
+        self.writer_depth = 0
+        self.writers_waiting = 0
+        self.local = threading.local() # per thread: shared-mode depth
+
+    @contextmanager
+    def shared(self):
+        me = threading.get_ident()
+        depth = getattr(self.local, 'depth', 0)
+        if self.writer == me or depth:
+            self.local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self.local.depth = depth
+            return
+
+        with self.cond:
+            while self.writer is not None or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+        self.local.depth = 1
+        try:
+            yield
+        finally:
+            self.local.depth = 0
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    def acquire(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.writer_depth += 1
+                return True
+            self.writers_waiting += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+            finally:
+                self.writers_waiting -= 1
+            self.writer = me
+            self.writer_depth = 1
+            return True
+
+    # True if the calling thread holds the lock in exclusive mode
+    def held_exclusively(self):
+        return self.writer == threading.get_ident()
+
+    def release(self):
+        with self.cond:
+            if self.writer != threading.get_ident():
+                raise RuntimeError("release of a SharedExclusiveLock not held in exclusive mode")
+            self.writer_depth -= 1
+            if not self.writer_depth:
+                self.writer = None
+                self.cond.notify_all()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class StripedLocks:
+    """
+    Per-book and per-user locks for circulation. Locks are striped (a fixed
+    array of locks, picked by book ID / user ID) so books and users do not
+    each carry a lock object; two items sharing a stripe only means they do
+    not run in parallel.
+
+    Lock order: every book lock before any user lock, and stripes in
+    ascending order within each kind. holding() takes them in that order, so
+    operations locking overlapping items cannot deadlock.
+    """
+
+    def __init__(self, stripes=256):
+        self.book_locks = [threading.Lock() for _ in range(stripes)]
+        self.user_locks = [threading.Lock() for _ in range(stripes)]
+
+    def book_stripe(self, book):
+        key = book.book_id if book.book_id is not None else id(book)
+        return key % len(self.book_locks)
+
+    def user_stripe(self, user):
+        key = user.user_id if user.user_id is not None else id(user)
+        return hash(key) % len(self.user_locks)
+
+    # holds the locks of the given books and users for the duration of the with block
+    @contextmanager
+    def holding(self, books=(), users=()):
+        book_stripes = sorted({self.book_stripe(book) for book in books})
+        user_stripes = sorted({self.user_stripe(user) for user in users})
+        with ExitStack() as stack:
+            for stripe in book_stripes:
+                stack.enter_context(self.book_locks[stripe])
+            for stripe in user_stripes:
+                stack.enter_context(self.user_locks[stripe])
+            yield
@@ -1,9 +1,26 @@
 class User: 
+    FIELDS = ('username', 'user_id', 'items_checked_out', 'items_on_hold', 'holds_pending', 'checkout_history')
+    # weak references let the lazy userbase find users it has evicted but that are still in use
+    __slots__ = FIELDS + ('__weakref__',)
+    
     def __init__(self, username:str):
         self.username = username
+        self.user_id = None # eg. "EECE0001", set when the user is registered
         self.items_checked_out = []
-        self.items_on_hold = []
+        self.items_on_hold = [] # books this user is waitlisted for or has a pending hold on
+        self.holds_pending = {} # book -> last day to pick up the held copy
         self.checkout_history = {}
+    
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in User.FIELDS}
+    
+    # users saved before user IDs, the hold index or checkout history existed
+    def __setstate__(self, state):
+        state.setdefault('user_id', None)
+        state.setdefault('holds_pending', {})
+        state.setdefault('checkout_history', {})
+        for name in User.FIELDS:
+            setattr(self, name, state.get(name))
         
     def print_hold_items(self):
         if len(self.items_on_hold)==0:
@@ -2,42 +2,158 @@
 # -*- coding: utf-8 -*-
 
 
-from collections import deque
 from datetime import timedelta
 from datetime import date
 
+# compact the queue once it holds more than this many removed entries (and they outnumber live ones)
+COMPACT_THRESHOLD = 32
+
 class Waitlist:
+    """
+    FIFO queue of users waiting for a book, plus the holds waiting to be picked up.
+
+    Every user who joins gets the next sequence number. Leaving the queue (from
+    the front or anywhere else) leaves a tombstone, and a Fenwick tree over the
+    sequence numbers counts the users still waiting, so joining, leaving,
+    advancing and looking up a position are all O(log n).
+    """
+    __slots__ = ('holds_pending', 'hold_item', 'slots', 'seq_of', 'head', 'tree')
+    
+    default_pending_hold_window = 3 
+    
     def __init__(self,book):
-        self.queue = deque()
         self.holds_pending = set()
         self.hold_item = book
-        self.default_pending_hold_window = 3 
+        self.__reset_queue([])
+    
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in Waitlist.__slots__}
+    
+    # waitlists saved before the Fenwick tree stored a plain deque of users
+    def __setstate__(self,state):
+        legacy_queue = state.pop('queue', None)
+        for name in Waitlist.__slots__:
+            if name in state:
+                setattr(self, name, state[name])
+        if legacy_queue is not None:
+            self.__reset_queue(list(legacy_queue))
         
     def __str__(self):
         return self.queue.__str__()
     
+    def __len__(self):
+        return len(self.seq_of)
+    
+    def __contains__(self,user):
+        return user in self.seq_of
+    
+    # users currently waiting, in order (O(n), for display)
+    @property
+    def queue(self):
+        return [user for user in self.slots[self.head:] if user is not None]
+    
+    def __reset_queue(self,users):
+        self.slots = list(users) # sequence number -> user, None once they have left
+        self.seq_of = {user: seq for seq, user in enumerate(self.slots)}
+        self.head = 0 # no live entry before this sequence number
+        # Fenwick tree (1-based) over slots, counting live entries. Built in O(n)
+        self.tree = [0] + [1] * len(self.slots)
+        for i in range(1, len(self.tree)):
+            parent = i + (i & -i)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[i]
+    
+    # adds delta to the count at sequence number seq
+    def __update(self,seq,delta):
+        i = seq + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+    
+    # number of live entries with sequence number < seq
+    def __prefix(self,seq):
+        total = 0
+        i = seq
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+    
+    # appends a live entry at the next sequence number
+    def __append(self,user):
+        seq = len(self.slots)
+        self.slots.append(user)
+        self.seq_of[user] = seq
+        i = seq + 1
+        # tree[i] covers sequence numbers (i - lowbit(i), i]
+        self.tree.append(1 + self.__prefix(i - 1) - self.__prefix(i - (i & -i)))
+    
+    # tombstones a user's entry, compacting once tombstones dominate
+    def __discard(self,user):
+        seq = self.seq_of.pop(user)
+        self.slots[seq] = None
+        self.__update(seq, -1)
+        tombstones = len(self.slots) - len(self.seq_of)
+        if tombstones > COMPACT_THRESHOLD and tombstones > len(self.seq_of):
+            self.__reset_queue(self.queue)
+    
+    # sequence number of the first live entry (the line leader), found by descending the tree
+    def __first_seq(self):
+        pos = 0
+        step = 1 << (len(self.tree).bit_length() - 1)
+        while step:
+            nxt = pos + step
+            if nxt < len(self.tree) and self.tree[nxt] < 1:
+                pos = nxt
+            step >>= 1
+        return pos
+    
     # adds a user to the waitlist and returns their position in queue
     def add_to_queue(self,user):
-        self.queue.append(user)
-        return len(self.queue)
+        if user in self.seq_of:
+            return self.get_pos(user)
+        self.__append(user)
+        return len(self.seq_of)
         
         
-    def advance_waitlist(self):
-        if not self.queue:
+    # current_date is the library's date (defaults to today), which starts the pickup window
+    def advance_waitlist(self,current_date=None):
+        if not self.seq_of:
             return
-        line_leader = self.queue.popleft()
-        checkout_window = self.calculate_checkout_window()
+        seq = self.__first_seq()
+        line_leader = self.slots[seq]
+        self.head = seq + 1
+        self.__discard(line_leader)
+        checkout_window = self.calculate_checkout_window(current_date)
         t = (line_leader,checkout_window)
         self.holds_pending.add(t)
+        # per-user reverse index, so the user's holds can be found without scanning books
+        line_leader.holds_pending[self.hold_item] = checkout_window
         print(f"{line_leader.username}, a copy of {self.hold_item.name} is now available to check out. You have 3 days to check it out before you automatically forfeit your spot in the waitlist.")
 
     
+    # removes a user from the queue and from the pending holds, if present.
+    # Returns True if anything was removed
+    def remove(self,user):
+        removed = False
+        if user in self.seq_of:
+            self.__discard(user)
+            removed = True
+        checkout_by = user.holds_pending.pop(self.hold_item, None)
+        if checkout_by is not None:
+            self.holds_pending.discard((user,checkout_by))
+            removed = True
+        return removed
+    
+    def has_pending_hold(self,user):
+        return self.hold_item in user.holds_pending
+    
     def get_pos(self,user):
-        try:
-            spot = self.queue.index(user) + 1
-            return spot
-        except ValueError:
+        seq = self.seq_of.get(user)
+        if seq is None:
             print(f"{user.username} is not currently in the waitlist.")
+            return None
+        return self.__prefix(seq) + 1
      
      
     # notifies the 1st user (leader) in waitlist when a book copy becomes available to them
@@ -46,8 +162,8 @@ class Waitlist:
         pass
     
       # returns the end date of the checkout window to collect book on hold
-    def calculate_checkout_window(self):
-        today = date.today()
+    def calculate_checkout_window(self,current_date=None):
+        today = date.today() if current_date is None else current_date
         checkout_by = today + timedelta(days=self.default_pending_hold_window)
         return checkout_by
     
@@ -57,8 +173,8 @@ class Waitlist:
     # removes any expired holds found, and prints a message
     # automatically calls notify_waitlist_leader for next users in waitlist
     def check_expired_holds(self,current_date):
-        # search through holds_pending set
-        for hold in self.holds_pending:
+        # search through holds_pending set (a copy, since expired holds are removed as we go)
+        for hold in list(self.holds_pending):
             user = hold[0]
             hold_exp_date = hold[1]
             # if the hold is expired
@@ -67,8 +183,10 @@ class Waitlist:
                 print(f"{user.username}'s hold on {self.hold_item.name} is now expired. Removing from waitlist...")
                 # remove the hold from holds_pending
                 self.holds_pending.remove(hold)
-                # remove the item from the user's holds_pending list
-                user.holds_pending.remove(self.hold_item)
+                # remove the item from the user's holds_pending index and hold list
+                user.holds_pending.pop(self.hold_item, None)
+                if self.hold_item in user.items_on_hold:
+                    user.items_on_hold.remove(self.hold_item)
                 # call notify_waitlist_leader
                 
                 
@@ -77,9 +195,10 @@ class Waitlist:
     def print_str(self):
         string = ""
         counter = 0
-        for item in self.queue:
+        queue = self.queue
+        for item in queue:
             string += item.username
-            if counter < len(self.queue)-1:
+            if counter < len(queue)-1:
                 string += ","
             counter+=1
         return string
@@ -2,26 +2,96 @@
 
 # -*- coding: utf-8 -*-\
 
+import os
+import time
 import pickle
+import threading
 from models.library import Library
 from auth.access_control import AccessControl # Needed for new Library initialization
+from journal import Journal
+from sqlite_store import SQLiteStore
+from userbase import LazyUserbase
+from snapshot import make_segment, segment_path, segment_paths, atomic_write, remove_segments, apply_segments
+from autosave import AutosaveService
 
 PICKLE_FILENAME = "catalogSystem.pkl"
+JOURNAL_FILENAME = "catalogSystem.journal"
+SQLITE_FILENAME = "catalogSystem.db"
+CHECKPOINT_EVERY = 200 # journaled operations between snapshots
+# pickle backend: saves write a segment with only the changed objects (see snapshot.py);
+# after this many segments they are compacted into a new full snapshot
+SEGMENTS_BEFORE_COMPACTION = 20
 
-def load_state(filepath_csv):
+# "pickle" (snapshot + journal) or "sqlite" (indexed tables, updated per operation)
+STORAGE_BACKEND = "pickle"
+# sqlite backend: read users on first access (LRU of USER_CACHE_SIZE) instead of at startup
+LAZY_USERS = True
+USER_CACHE_SIZE = 1000
+# pickle backend: seconds without new operations before the background autosave writes them,
+# and the longest a saved operation can wait while operations keep coming
+AUTOSAVE_QUIET_PERIOD = 2.0
+AUTOSAVE_MAX_DELAY = 30.0
+
+# one save at a time (the autosave thread and the main thread)
+_save_lock = threading.Lock()
+
+def load_state(filepath_csv, backend=None):
     """
-    Loads the Library object and User registry from a pickle file.
-    Initializes a new system if the file is not found.
+    Loads the Library object and User registry.
+    
+    pickle backend: the last full snapshot (pickle file) merged with the incremental
+    segments saved after it, then replays the operations journaled since.
+    sqlite backend: rebuilds the state from the database tables, and keeps them
+    updated as each operation is applied.
+    Initializes a new system if no saved state is found.
     
     Returns: (library_object, userbase_dictionary)
     """
+    backend = backend or STORAGE_BACKEND
+    if backend == "sqlite":
+        return load_sqlite_state(filepath_csv)
+    library, userbase = load_snapshot(filepath_csv)
+    attach_journal(library, userbase)
+    return library, userbase
+
+def load_sqlite_state(filepath_csv):
+    store = SQLiteStore(SQLITE_FILENAME)
+    if store.is_new():
+        print(f"[PERSISTENCE] No saved state found ({SQLITE_FILENAME}). Initializing new library.")
+        library = Library(AccessControl())
+        library.parse_CSV(filepath_csv)
+        store.save_all(library, {})
+        userbase = LazyUserbase(store, capacity=USER_CACHE_SIZE) if LAZY_USERS else {}
+    else:
+        library, userbase = store.load(lazy_users=LAZY_USERS)
+        if LAZY_USERS:
+            userbase.capacity = USER_CACHE_SIZE
+        print(f"[PERSISTENCE] State loaded from {SQLITE_FILENAME}. {len(userbase)} users registered.")
+    store.attach(library, userbase)
+    return library, userbase
+
+def load_snapshot(filepath_csv):
     try:
         with open(PICKLE_FILENAME, 'rb') as f:
             # We save and load a tuple: (Library object, userbase dictionary {ID: User_object})
             # This step loads all library data and all user objects
             library, userbase = pickle.load(f)
-            print(f"[PERSISTENCE] State loaded from {PICKLE_FILENAME}. {len(userbase)} users registered.")
-            return library, userbase
+        # users saved before user IDs / checkout history / hold index existed on the User object
+        for user_id, user_obj in userbase.items():
+            if getattr(user_obj, 'user_id', None) is None:
+                user_obj.user_id = user_id
+            if not hasattr(user_obj, 'checkout_history'):
+                user_obj.checkout_history = {}
+            if not hasattr(user_obj, 'holds_pending'):
+                user_obj.holds_pending = {}
+        # changes saved incrementally since that snapshot
+        segments = apply_segments(PICKLE_FILENAME, library, userbase)
+        if segments:
+            print(f"[PERSISTENCE] Merged {segments} incremental snapshot segment(s).")
+        # states saved before (or by an older version of) search indexing need a rebuild
+        library.ensure_indexes()
+        print(f"[PERSISTENCE] State loaded from {PICKLE_FILENAME}. {len(userbase)} users registered.")
+        return library, userbase
     except FileNotFoundError:
         print(f"[PERSISTENCE] No saved state found ({PICKLE_FILENAME}). Initializing new library.")
         
@@ -39,18 +109,110 @@ def load_state(filepath_csv):
         new_library.parse_CSV(filepath_csv)
         return new_library, {}
 
-def save_state(library, userbase):
+def attach_journal(library, userbase):
     """
-    Saves the global library object and userbase using pickle.
+    Replays the journal on top of the loaded snapshot, then attaches it to the
+    library so every following mutation is journaled as it happens.
     """
+    journal = Journal(JOURNAL_FILENAME, checkpoint_every=CHECKPOINT_EVERY)
+    replayed = journal.replay(library, userbase)
+    if replayed:
+        print(f"[PERSISTENCE] Replayed {replayed} journaled operations from {JOURNAL_FILENAME}.")
+    journal.on_checkpoint = lambda: save_state(library, userbase)
+    library.journal = journal
+    return journal
+
+def save_state(library, userbase, full=False):
+    """
+    Saves the global library object and userbase (a checkpoint), then empties
+    the journal since the snapshot now contains its operations.
+    
+    pickle backend: writes a segment holding only the books, users and roles
+    changed since the last save. A full pickle (base snapshot) is written when
+    there is none yet, when full=True, when a change can only be captured by a
+    full snapshot, or once SEGMENTS_BEFORE_COMPACTION segments have piled up;
+    the segments it replaces are then deleted.
+    With the sqlite backend every operation is already stored, so nothing is dumped.
+    """
+    if isinstance(library.journal, SQLiteStore):
+        try:
+            library.journal.flush()
+            print(f"[PERSISTENCE] Library state is up to date in {SQLITE_FILENAME}.")
+            return True
+        except Exception as e:
+            print(f"[PERSISTENCE ERROR] Failed to save library data: {e}")
+            return False
     try:
-        # Saving the tuple containing the Library and the Userbase ensures
-        # all book data, user data, and user roles are saved.
-        data_to_save = (library, userbase)
-        with open(PICKLE_FILENAME, 'wb') as f:
-            pickle.dump(data_to_save, f)
-        print(f"[PERSISTENCE] Library state successfully saved to {PICKLE_FILENAME}.")
+        stats = write_snapshot(library, userbase, full)
+        if stats["full"]:
+            print(f"[PERSISTENCE] Library state successfully saved to {PICKLE_FILENAME}.")
+        else:
+            print(f"[PERSISTENCE] Library changes successfully saved to {stats['path']}.")
         return True
     except Exception as e:
         print(f"[PERSISTENCE ERROR] Failed to save library data: {e}")
         return False
+
+def write_snapshot(library, userbase, full=False):
+    """
+    Writes a snapshot (pickle backend) and returns its stats: {"path", "full",
+    "bytes", "capture_ms", "write_ms"}. Raises on failure.
+    
+    Only capturing the state (pickling it to bytes) holds the library lock, so
+    operations on other threads wait at most capture_ms; the file is written
+    (temp file + fsync + atomic rename) after the lock is released.
+    Must not be called while holding library.lock from another save.
+    """
+    with _save_lock:
+        start = time.perf_counter()
+        with library.lock:
+            full = (full or library.changes.full or not os.path.exists(PICKLE_FILENAME)
+                    or len(segment_paths(PICKLE_FILENAME)) >= SEGMENTS_BEFORE_COMPACTION)
+            library.snapshot_seq += 1
+            if full:
+                # Saving the tuple containing the Library and the Userbase ensures
+                # all book data, user data, and user roles are saved.
+                path = PICKLE_FILENAME
+                data = pickle.dumps((library, userbase))
+            else:
+                path = segment_path(PICKLE_FILENAME, library.snapshot_seq)
+                data = pickle.dumps(make_segment(library))
+            library.changes.clear()
+            snapshot_seq = library.snapshot_seq
+            journal_seq = library.journal_seq
+        captured = time.perf_counter()
+
+        try:
+            atomic_write(path, data)
+        except Exception:
+            # the changes were cleared when they were captured; only a full snapshot has them now
+            library.changes.mark_all()
+            raise
+        if full:
+            remove_segments(PICKLE_FILENAME, snapshot_seq)
+
+        with library.lock:
+            # operations journaled while the file was written are not in it, so keep them
+            # (records the snapshot already contains are skipped when the journal is replayed)
+            if library.journal is not None and library.journal_seq == journal_seq:
+                library.journal.reset()
+        written = time.perf_counter()
+
+    return {"path": path, "full": full, "bytes": len(data),
+            "capture_ms": (captured - start) * 1000, "write_ms": (written - captured) * 1000}
+
+def start_autosave(library, userbase):
+    """
+    Starts saving the library in the background (pickle backend) once operations
+    have stopped coming for AUTOSAVE_QUIET_PERIOD seconds, or every AUTOSAVE_MAX_DELAY
+    seconds while they keep coming. Journal checkpoints are handed to the same thread.
+    Returns the AutosaveService, or None with the sqlite backend (already saved per operation).
+    """
+    if isinstance(library.journal, SQLiteStore):
+        return None
+    service = AutosaveService(lambda full=False: write_snapshot(library, userbase, full),
+                              lambda: library.changes.mutations, AUTOSAVE_QUIET_PERIOD, AUTOSAVE_MAX_DELAY)
+    if library.journal is not None:
+        library.journal.on_checkpoint = service.request_save
+    service.start()
+    return service
@@ -0,0 +1,515 @@
+# service.py
+
+# -*- coding: utf-8 -*-
+
+"""
+Headless HTTP/JSON front-end for the Library, for kiosk clients.
+
+Runs one asyncio event loop that accepts connections and parses requests;
+the Library calls themselves run on a pool of worker threads (the Library
+is thread-safe, see models/locks.py), so a slow search or report never
+stalls the other clients. Requests that arrive together are handed to the
+pool in batches (RequestBatcher), and a client can also send several
+operations in one POST /batch.
+
+Endpoints (bodies and responses are JSON; a session token from /login goes
+in the X-Session header):
+    POST /register          {"username"}                  -> {"user_id"}
+    POST /login             {"user_id"}                   -> {"token", "user", "admin"}
+    POST /logout
+    GET  /me                                              -> the user's loans and holds
+    GET  /search            ?q=&by=title&limit=&offset=&available=1
+    GET  /autocomplete      ?prefix=&field=title&limit=
+    GET  /recommendations
+    POST /checkout          {"book_id"}
+    POST /return            {"book_id"}
+    POST /checkout_many     {"book_ids": [...]}           -> one result per book
+    POST /return_many       {"book_ids": [...]}           -> one result per book (eg. a book drop)
+    GET  /admin/overdue                                   -> overdue copies and late fees
+    GET  /admin/catalog                                   -> every user's loans, waitlists and holds
+    POST /admin/date        {"date": "YYYY-MM-DD"}
+    POST /batch             {"requests": [{"method", "path", "body"}, ...]}
+    GET  /metrics
+
+Run from the src folder: python service.py [--host 127.0.0.1] [--port 8080] [--workers N]
+"""
+
+import os
+import sys
+import json
+import time
+import secrets
+import asyncio
+import argparse
+from pathlib import Path
+from datetime import date
+from urllib.parse import urlsplit, parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+
+from persistence import load_state, save_state, start_autosave
+from models.library import CirculationError
+from auth.default_roles import member_role, admin_role
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+MAX_BATCH = 64 # requests taken off the queue at once (spread over the workers)
+MAX_BODY = 1 << 20 # bytes
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden",
+               404: "Not Found", 405: "Method Not Allowed", 409: "Conflict",
+               413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# =========================
+# JSON views of library objects
+# =========================
+
+def _iso(day):
+    return None if day is None else day.isoformat()
+
+def book_json(book):
+    return {"book_id": book.book_id, "title": book.name, "author": book.author, "genre": book.genre,
+            "subgenre": book.subgenre, "copies": book.num_copies, "available": book.available_count()}
+
+def user_json(user):
+    return {"user_id": user.user_id, "username": user.username}
+
+def record_json(record):
+    return {key: (value.isoformat() if isinstance(value, date) else value) for key, value in record.items()}
+
+
+class RequestBatcher:
+    """
+    Hands library calls to the worker pool in batches.
+
+    Calls submitted while the loop is busy queue up; the batcher takes
+    everything queued (up to max_batch) and splits it into one slice per
+    worker thread, so under load each thread hand-off carries several
+    requests while every worker stays busy and no request waits behind more
+    than its share of the batch. An idle service still answers a lone
+    request straight away.
+    """
+
+    def __init__(self, executor, workers, max_batch=MAX_BATCH):
+        self.executor = executor
+        self.workers = workers
+        self.max_batch = max_batch
+        self.queue = None
+        self.task = None
+        self.batches = 0
+        self.calls = 0
+        self.largest_batch = 0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.__run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    # runs func(*args) on a worker thread and returns (or raises) its result
+    async def submit(self, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((func, args, future))
+        return await future
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self.batches += 1
+            self.calls += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            slices = min(self.workers, len(batch))
+            for i in range(slices):
+                loop.run_in_executor(self.executor, self.__run_batch, loop, batch[i::slices])
+
+    @staticmethod
+    def __run_batch(loop, batch):
+        for func, args, future in batch:
+            try:
+                result, error = func(*args), None
+            except BaseException as e:
+                result, error = None, e
+            loop.call_soon_threadsafe(RequestBatcher.__resolve, future, result, error)
+
+    @staticmethod
+    def __resolve(future, result, error):
+        if future.done(): # the client went away
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+class LibraryService:
+    """
+    Maps HTTP requests onto the Library API. Permission checks stay in the
+    Library (a PermissionError becomes a 403); handlers only look up the
+    session's user and the books named in the request.
+    """
+
+    def __init__(self, library, userbase, workers=None, max_batch=MAX_BATCH):
+        self.library = library
+        self.userbase = userbase
+        workers = workers or min(32, (os.cpu_count() or 1) + 4) # ThreadPoolExecutor's default
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="library")
+        self.batcher = RequestBatcher(self.executor, workers, max_batch)
+        self.sessions = {} # token -> user ID
+        self.server = None
+        self.started_at = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.routes = {
+            ("POST", "/register"): (self.register, False),
+            ("POST", "/login"): (self.login, False),
+            ("POST", "/logout"): (self.logout, True),
+            ("GET", "/me"): (self.me, True),
+            ("GET", "/search"): (self.search, True),
+            ("GET", "/autocomplete"): (self.autocomplete, True),
+            ("GET", "/recommendations"): (self.recommendations, True),
+            ("POST", "/checkout"): (self.checkout, True),
+            ("POST", "/return"): (self.return_item, True),
+            ("POST", "/checkout_many"): (self.checkout_many, True),
+            ("POST", "/return_many"): (self.return_many, True),
+            ("GET", "/admin/overdue"): (self.overdue_report, True),
+            ("GET", "/admin/catalog"): (self.catalog_report, True),
+            ("POST", "/admin/date"): (self.set_date, True),
+            ("GET", "/metrics"): (self.metrics, False),
+        }
+
+    # =========================
+    # Handlers (run on worker threads): handler(user, params) -> JSON-able result
+    # =========================
+
+    def register(self, user, params):
+        username = str(params.get("username", "")).strip()
+        if not username:
+            raise ServiceError(400, "username is required")
+        user_id, new_user = self.library.register_user(self.userbase, username, [member_role])
+        return {"user_id": user_id}
+
+    def login(self, user, params):
+        user_id = str(params.get("user_id", "")).strip().upper()
+        if user_id not in self.userbase:
+            raise ServiceError(401, "Invalid user ID")
+        user = self.userbase[user_id]
+        token = secrets.token_urlsafe(16)
+        self.sessions[token] = user_id
+        return {"token": token, "user": user_json(user),
+                "admin": bool(self.library.ac.has_permission(user.username, "set_date"))}
+
+    def logout(self, user, params):
+        self.sessions.pop(params.get("_token"), None)
+        return {"ok": True}
+
+    def me(self, user, params):
+        return {"user": user_json(user),
+                "checked_out": [{"book": book_json(book), "slot": copy["slot"], "due": _iso(copy["return_date"])}
+                                for book, copy in list(user.items_checked_out)],
+                "holds": [{"book": book_json(hold["book"]), "status": hold["status"], "position": hold["position"],
+                           "pickup_by": _iso(hold["pickup_by"])}
+                          for hold in self.library.get_user_holds(user)]}
+
+    def search(self, user, params):
+        term = str(params.get("q", "")).strip()
+        if not term:
+            raise ServiceError(400, "q is required")
+        limit = _int_param(params, "limit", 50)
+        offset = _int_param(params, "offset", 0)
+        available = str(params.get("available", "")).lower() in ("1", "true", "yes")
+        books = self.library.search_catalog(term, params.get("by", "title"), limit=limit, offset=offset,
+                                            available_only=available)
+        return {"results": [book_json(book) for book in books]}
+
+    def autocomplete(self, user, params):
+        return {"suggestions": self.library.autocomplete(str(params.get("prefix", "")), params.get("field", "title"),
+                                                         limit=_int_param(params, "limit", 10))}
+
+    def recommendations(self, user, params):
+        return {"results": [book_json(book) for book in self.library.recommend_books(user)]}
+
+    def checkout(self, user, params):
+        return {"message": self.library.checkout_item(self.__book(params), user)}
+
+    def return_item(self, user, params):
+        return {"message": self.library.return_item(self.__book(params), user)}
+
+    def checkout_many(self, user, params):
+        return {"results": [self.__item_result(result)
+                            for result in self.library.checkout_many([(book, user) for book in self.__books(params)])]}
+
+    def return_many(self, user, params):
+        return {"results": [self.__item_result(result)
+                            for result in self.library.return_many([(book, user) for book in self.__books(params)])]}
+
+    @staticmethod
+    def __item_result(result):
+        return {"book_id": result["book"].book_id, "ok": result["ok"], "message": result["message"]}
+
+    def overdue_report(self, user, params):
+        overdue = self.library.check_overdue(user)
+        summary = self.library.loan_summary(user)
+        return {"date": _iso(self.library.current_date),
+                "loans": summary["loans"],
+                "overdue": [{"book": book_json(record["book"]), "slot": record["copy_index"],
+                             "borrower": user_json(record["borrower"]), "due": _iso(record["return_date"]),
+                             "days_overdue": record["days_overdue"]} for record in overdue],
+                "late_fees": {borrower.user_id: fee for borrower, fee in summary["late_fees"].items()}}
+
+    def catalog_report(self, user, params):
+        return {"records": [record_json(record) for record in self.library.iter_catalog(user, self.userbase.values())]}
+
+    def set_date(self, user, params):
+        try:
+            new_date = date.fromisoformat(str(params.get("date", "")))
+        except ValueError:
+            raise ServiceError(400, "date must be YYYY-MM-DD")
+        self.library.set_date(new_date, user)
+        return {"date": _iso(self.library.current_date)}
+
+    def metrics(self, user, params):
+        return {"uptime_s": round(time.time() - self.started_at, 1), "requests": self.requests,
+                "errors": self.errors, "sessions": len(self.sessions), "batches": self.batcher.batches,
+                "mean_batch": round(self.batcher.calls / self.batcher.batches, 2) if self.batcher.batches else 0.0,
+                "largest_batch": self.batcher.largest_batch, "permission_checks": self.library.ac.stats()}
+
+    def __book(self, params):
+        try:
+            book_id = int(params.get("book_id"))
+        except (TypeError, ValueError):
+            raise ServiceError(400, "book_id must be an integer")
+        book = self.library.books_by_id.get(book_id)
+        if book is None:
+            raise ServiceError(404, f"No book with ID {book_id}")
+        return book
+
+    def __books(self, params):
+        book_ids = params.get("book_ids")
+        if not isinstance(book_ids, list):
+            raise ServiceError(400, "book_ids must be a list")
+        return [self.__book({"book_id": book_id}) for book_id in book_ids]
+
+    # =========================
+    # Dispatch
+    # =========================
+
+    # runs one request on a worker thread: resolves the session, then calls the handler
+    def __call(self, handler, needs_login, token, params):
+        user = None
+        if needs_login:
+            user_id = self.sessions.get(token)
+            if user_id is None or user_id not in self.userbase:
+                raise ServiceError(401, "Log in first (POST /login) and send the token as X-Session")
+            user = self.userbase[user_id]
+        return handler(user, params)
+
+    # returns (status, JSON-able body) for one request
+    async def dispatch(self, method, path, token, params):
+        self.requests += 1
+        if (method, path) == ("POST", "/batch"):
+            return await self.__batch(token, params)
+        route = self.routes.get((method, path))
+        if route is None:
+            if any(route_path == path for route_method, route_path in self.routes):
+                return self.__error(405, f"{method} not allowed on {path}")
+            return self.__error(404, f"No endpoint {path}")
+        handler, needs_login = route
+        try:
+            result = await self.batcher.submit(self.__call, handler, needs_login, token, dict(params, _token=token))
+        except ServiceError as e:
+            return self.__error(e.status, str(e))
+        except PermissionError as e:
+            return self.__error(403, str(e))
+        except CirculationError as e:
+            # the library refused the request (eg. "Added to waitlist")
+            return self.__error(409, str(e))
+        except Exception as e:
+            print(f"[ERROR] Service request {method} {path} failed: {type(e).__name__}: {e}")
+            return self.__error(500, "Internal error")
+        return 200, result
+
+    # runs the requests of a POST /batch in order (a return can follow its checkout); each
+    # gets its own status. Returns (status, body) like dispatch
+    async def __batch(self, token, params):
+        requests = params.get("requests")
+        if not isinstance(requests, list):
+            return self.__error(400, "requests must be a list")
+        async def run(request):
+            if not isinstance(request, dict):
+                return 400, {"error": "each request must be an object"}
+            path = urlsplit(str(request.get("path", ""))).path
+            method = str(request.get("method", "GET")).upper()
+            body = request.get("body") or {}
+            if (method, path) == ("POST", "/batch"):
+                return 400, {"error": "batches cannot be nested"}
+            return await self.dispatch(method, path, token, body)
+        results = [await run(request) for request in requests]
+        return 200, {"responses": [{"status": status, "body": body} for status, body in results]}
+
+    def __error(self, status, message):
+        self.errors += 1
+        return status, {"error": message}
+
+    # =========================
+    # HTTP/1.1 over asyncio streams
+    # =========================
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.__respond(writer, 400, {"error": "Malformed request line"}, False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = (headers.get("connection", "").lower() != "close"
+                              and version.upper() == "HTTP/1.1")
+
+                try:
+                    length = int(headers.get("content-length", 0) or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self.__respond(writer, 400, {"error": "Invalid Content-Length"}, False)
+                    break
+                if length > MAX_BODY:
+                    await self.__respond(writer, 413, {"error": "Request body too large"}, False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                url = urlsplit(target)
+                params = dict(parse_qsl(url.query))
+                if body:
+                    try:
+                        payload = json.loads(body)
+                    except ValueError:
+                        await self.__respond(writer, 400, {"error": "Body must be JSON"}, keep_alive)
+                        if not keep_alive:
+                            break
+                        continue
+                    if not isinstance(payload, dict):
+                        await self.__respond(writer, 400, {"error": "Body must be a JSON object"}, keep_alive)
+                        if not keep_alive:
+                            break
+                        continue
+                    params.update(payload)
+
+                try:
+                    status, result = await self.dispatch(method.upper(), url.path, headers.get("x-session"), params)
+                except Exception as e:
+                    print(f"[ERROR] Service request {method} {url.path} failed: {e}")
+                    status, result = self.__error(500, "Internal error")
+                await self.__respond(writer, status, result, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def __respond(self, writer, status, result, keep_alive):
+        body = json.dumps(result, default=str).encode("utf-8")
+        head = (f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        await self.batcher.stop()
+        self.executor.shutdown(wait=True)
+
+    async def serve_forever(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        server = await self.start(host, port)
+        addresses = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+        print(f"[DEBUG] Library service listening on {addresses}")
+        try:
+            await server.serve_forever()
+        finally:
+            await self.stop()
+
+
+def _int_param(params, name, default):
+    value = params.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ServiceError(400, f"{name} must be an integer")
+    if value < 0:
+        raise ServiceError(400, f"{name} must not be negative")
+    return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP/JSON service for the library")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=None, help="worker threads for library calls")
+    args = parser.parse_args(argv)
+
+    # like main.py, run from the src folder
+    dataset_filepath = Path.cwd().parent/"Sample Datasets"/"books_new.csv"
+    library, userbase = load_state(dataset_filepath)
+    if not userbase:
+        admin_id, admin = library.register_user(userbase, "admin", [admin_role, member_role])
+        print(f"[SETUP] Default admin created with ID: {admin_id}")
+    autosave = start_autosave(library, userbase)
+
+    service = LibraryService(library, userbase, workers=args.workers)
+    try:
+        asyncio.run(service.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if autosave is not None:
+            autosave.stop(final_save=False)
+        if not save_state(library, userbase):
+            print("[ERROR] Failed to save library state on shutdown.")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
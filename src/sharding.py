@@ -0,0 +1,511 @@
+# sharding.py
+
+# -*- coding: utf-8 -*-
+
+"""
+Sharded mode: the catalog is split across several worker processes, each
+owning a Library shard with its own persistence files, so searches, reports
+and circulation use more than one core.
+
+Books are assigned to shards by a stable hash of their normalized (title,
+author) (see shard_of), and keep the shard's own book IDs; the IDs handed
+out by the router encode both (local_id * shards + shard). Users exist on
+every shard: the router registers each user on all of them, in the same
+order, so every shard gives them the same ID and roles.
+
+ShardedLibrary is the router. Circulation and catalog changes go to the
+shard that owns the book; searches, overdue scans, loan summaries and
+recommendations are sent to every shard at once and the results merged.
+Results are plain dicts (books as {"book_id", "title", ...}) since Book and
+User objects live in the worker processes.
+
+    with ShardedLibrary("shards", shards=4, filepath_csv="../Sample Datasets/books_new.csv") as library:
+        user_id = library.register_user("ada", [member_role])
+        book = library.search_catalog("data", "title", limit=1)[0]
+        library.checkout_item(book["book_id"], user_id)
+"""
+
+import os
+import csv
+import json
+import threading
+import multiprocessing
+from pathlib import Path
+from datetime import date
+
+from models.csv_ingest import iter_csv_rows, book_key, DEFAULT_CHUNKSIZE
+from models.library import CirculationError
+
+MANIFEST_FILENAME = "shards.json"
+SHARD_CATALOG_FILENAME = "books.csv"
+DEFAULT_SHARDS = 4
+
+
+# the shard a book belongs to, from its normalized (title, author); the same in every process
+def shard_of(title, author, shards):
+    return int.from_bytes(book_key(title, author)[:8], 'big') % shards
+
+# router book IDs <-> (shard, shard's own book ID)
+def global_book_id(local_id, shard, shards):
+    return local_id * shards + shard
+
+def split_book_id(book_id, shards):
+    return book_id % shards, book_id // shards
+
+def shard_directory(directory, index):
+    return Path(directory) / f"shard-{index:02d}"
+
+# writes each shard's part of a book dataset to <shard directory>/books.csv, which the shard
+# loads the first time it starts. Rows missing a title, author or genre are skipped (as
+# Library.parse_CSV does). Returns the number of books per shard
+def split_catalog(filepath_csv, directory, shards, chunksize=DEFAULT_CHUNKSIZE):
+    counts = [0] * shards
+    files = []
+    try:
+        writers = []
+        for index in range(shards):
+            path = shard_directory(directory, index) / SHARD_CATALOG_FILENAME
+            f = open(path, 'w', newline='', encoding='utf-8')
+            files.append(f)
+            writer = csv.writer(f)
+            writer.writerow(["Title", "Author", "Genre", "SubGenre"])
+            writers.append(writer)
+        try:
+            for row_number, title, author, genre, subgenre in iter_csv_rows(filepath_csv, chunksize):
+                if title is None or author is None or genre is None:
+                    continue
+                index = shard_of(title, author, shards)
+                writers[index].writerow([title, author, genre, "" if subgenre is None else subgenre])
+                counts[index] += 1
+        except FileNotFoundError:
+            print(f"[ERROR] Failed to load CSV file. File not found at {filepath_csv}.")
+    finally:
+        for f in files:
+            f.close()
+    print(f"[DEBUG] Split {sum(counts)} books across {shards} shards: {counts}")
+    return counts
+
+
+class ShardWorker:
+    """
+    The operations a shard process runs for the router, over its own Library.
+    Takes and returns plain values (IDs, dicts) that can cross the process
+    boundary; book IDs in and out are router book IDs.
+    """
+
+    def __init__(self, index, shards, library, userbase):
+        self.index = index
+        self.shards = shards
+        self.library = library
+        self.userbase = userbase
+
+    def book_json(self, book):
+        return {"book_id": global_book_id(book.book_id, self.index, self.shards), "title": book.name,
+                "author": book.author, "genre": book.genre, "subgenre": book.subgenre,
+                "copies": book.num_copies, "available": book.available_count()}
+
+    def __book(self, book_id):
+        shard, local_id = split_book_id(book_id, self.shards)
+        book = self.library.books_by_id.get(local_id) if shard == self.index else None
+        if book is None:
+            raise LookupError(f"No book with ID {book_id}")
+        return book
+
+    def __user(self, user_id):
+        user = self.userbase.get(user_id)
+        if user is None:
+            raise LookupError(f"No user with ID {user_id}")
+        return user
+
+    def ping(self):
+        return {"shard": self.index, "books": len(self.library.inventory), "loans": len(self.library.loans),
+                "users": len(self.userbase), "user_id_counter": self.library.user_id_counter}
+
+    def has_user(self, user_id):
+        return user_id in self.userbase
+
+    def register_user(self, username, roles):
+        user_id, user = self.library.register_user(self.userbase, username, roles)
+        return user_id
+
+    # matches as (sort key, book): by relevance, (-score, shard book ID); otherwise the shard's
+    # catalog order. limit counts from the first match (the router applies the offset)
+    def search(self, search_term, search_by, limit, available_only):
+        if search_by.lower() == 'relevance':
+            ranked = self.library.search_ranked(search_term, limit=limit, available_only=available_only, with_scores=True)
+            return [((-score, book.book_id), self.book_json(book)) for score, book in ranked]
+        books = self.library.search_catalog(search_term, search_by, limit=limit, available_only=available_only)
+        return [((book.book_id,), self.book_json(book)) for book in books]
+
+    def autocomplete(self, prefix, field, limit):
+        return self.library.autocomplete(prefix, field, limit)
+
+    def checkout_item(self, book_id, user_id):
+        return self.library.checkout_item(self.__book(book_id), self.__user(user_id))
+
+    def return_item(self, book_id, user_id):
+        return self.library.return_item(self.__book(book_id), self.__user(user_id))
+
+    def checkout_many(self, items):
+        return self.__batch_results(self.library.checkout_many(self.__batch_items(items)))
+
+    def return_many(self, items):
+        return self.__batch_results(self.library.return_many(self.__batch_items(items)))
+
+    def __batch_items(self, items):
+        return [(self.__book(book_id), self.__user(user_id)) for book_id, user_id in items]
+
+    def __batch_results(self, results):
+        return [{"book_id": global_book_id(result["book"].book_id, self.index, self.shards),
+                 "user_id": result["user"].user_id, "ok": result["ok"], "message": result["message"]}
+                for result in results]
+
+    def check_overdue(self, admin_id):
+        return [{"book": self.book_json(record["book"]), "slot": record["copy_index"],
+                 "borrower": record["borrower"].user_id, "return_date": record["return_date"].isoformat(),
+                 "days_overdue": record["days_overdue"]}
+                for record in self.library.check_overdue(self.__user(admin_id))]
+
+    def loan_summary(self, admin_id):
+        summary = self.library.loan_summary(self.__user(admin_id))
+        by_id = lambda counts: {user.user_id: value for user, value in counts.items()}
+        return {"loans": summary["loans"], "overdue": summary["overdue"],
+                "outstanding": by_id(summary["outstanding"]), "overdue_by_user": by_id(summary["overdue_by_user"]),
+                "late_fees": by_id(summary["late_fees"])}
+
+    def set_date(self, new_date, admin_id):
+        self.library.set_date(new_date, self.__user(admin_id))
+        return self.library.current_date
+
+    def add_item(self, title, author, genre, subgenre, admin_id):
+        from models.book import Book
+        book = Book(title, author, genre, subgenre)
+        if not self.library.add_item(book, self.__user(admin_id)):
+            return None
+        return global_book_id(book.book_id, self.index, self.shards)
+
+    def remove_item(self, book_id, admin_id):
+        return self.library.remove_item(self.__book(book_id), self.__user(admin_id))
+
+    def checkout_history(self, user_id):
+        return dict(self.__user(user_id).checkout_history)
+
+    # up to limit books of genre that user_id does not have out, as (shard book ID, book)
+    def recommend(self, user_id, genre, limit):
+        user = self.__user(user_id)
+        checked_out = {book for book, copy in user.items_checked_out}
+        recommendations = []
+        for book in self.library.inventory:
+            if len(recommendations) == limit:
+                break
+            if book.genre.lower() == genre.lower() and book not in checked_out:
+                recommendations.append((book.book_id, self.book_json(book)))
+        return recommendations
+
+    def user_items(self, user_id):
+        user = self.__user(user_id)
+        return {"checked_out": [{"book": self.book_json(book), "slot": copy["slot"],
+                                 "due": copy["return_date"].isoformat() if copy["return_date"] else None}
+                                for book, copy in user.items_checked_out],
+                "holds": [{"book": self.book_json(hold["book"]), "status": hold["status"], "position": hold["position"],
+                           "pickup_by": hold["pickup_by"].isoformat() if hold["pickup_by"] else None}
+                          for hold in self.library.get_user_holds(user)]}
+
+
+# body of a shard process: loads (or creates) the shard's state in its directory and serves
+# (op, args) requests from the router over conn until told to stop, then saves
+def _shard_main(index, shards, directory, filepath_csv, conn):
+    # the persistence files are relative to the working directory, so each shard gets its own
+    os.chdir(directory)
+    from persistence import load_state, save_state, start_autosave
+    library, userbase = load_state(filepath_csv)
+    autosave = start_autosave(library, userbase)
+    worker = ShardWorker(index, shards, library, userbase)
+    conn.send((True, None))
+
+    try:
+        while True:
+            try:
+                op, args = conn.recv()
+            except EOFError:
+                break # the router went away
+            if op == "stop":
+                break
+            try:
+                if op.startswith("_") or not hasattr(worker, op):
+                    raise AttributeError(f"Unknown shard operation: {op}")
+                reply = (True, getattr(worker, op)(*args))
+            except Exception as e:
+                reply = (False, (type(e).__name__, str(e)))
+            conn.send(reply)
+    finally:
+        if autosave is not None:
+            autosave.stop(final_save=False)
+        saved = save_state(library, userbase)
+        try:
+            conn.send((saved, None))
+        except (OSError, EOFError):
+            pass
+
+
+class ShardedLibrary:
+    """
+    Router over `shards` Library processes stored under directory
+    (directory/shard-NN/). The number of shards is fixed when the directory
+    is first created (recorded in shards.json); on that first start the
+    dataset at filepath_csv is split between them.
+
+    Safe to call from several threads: requests to different shards run in
+    parallel, and a fan-out sends to every shard before waiting for any.
+    """
+
+    def __init__(self, directory, shards=DEFAULT_SHARDS, filepath_csv=None):
+        self.directory = Path(directory)
+        self.shards = shards
+        self.filepath_csv = filepath_csv
+        self.processes = []
+        self.connections = []
+        self.locks = [] # one per shard: a request and its reply are not interleaved with others
+        self.register_lock = threading.Lock() # users are registered on every shard in the same order
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        manifest = self.directory / MANIFEST_FILENAME
+        if manifest.exists():
+            with open(manifest, 'r', encoding='utf-8') as f:
+                saved_shards = json.load(f)["shards"]
+            if saved_shards != self.shards:
+                raise ValueError(f"{self.directory} holds {saved_shards} shards, not {self.shards}")
+        else:
+            for index in range(self.shards):
+                shard_directory(self.directory, index).mkdir(exist_ok=True)
+            if self.filepath_csv is not None:
+                split_catalog(self.filepath_csv, self.directory, self.shards)
+            with open(manifest, 'w', encoding='utf-8') as f:
+                json.dump({"shards": self.shards}, f)
+
+        context = multiprocessing.get_context("spawn")
+        for index in range(self.shards):
+            directory = shard_directory(self.directory, index)
+            router_end, shard_end = context.Pipe()
+            process = context.Process(target=_shard_main, name=f"library-shard-{index}",
+                                      args=(index, self.shards, str(directory.resolve()),
+                                            str((directory / SHARD_CATALOG_FILENAME).resolve()), shard_end))
+            process.start()
+            shard_end.close()
+            self.processes.append(process)
+            self.connections.append(router_end)
+            self.locks.append(threading.Lock())
+        for index, connection in enumerate(self.connections):
+            try:
+                connection.recv() # ready
+            except EOFError:
+                self.stop()
+                raise RuntimeError(f"Shard {index} failed to start") from None
+
+        counters = {status["user_id_counter"] for status in self.stats()}
+        if len(counters) > 1:
+            print(f"[ERROR] Shards disagree on the registered users ({sorted(counters)}); "
+                  f"users registered while a shard was down are missing from it.")
+        return self
+
+    # asks every shard to save and exit. Returns True if every shard saved
+    def stop(self):
+        saved = True
+        for index, connection in enumerate(self.connections):
+            with self.locks[index]:
+                try:
+                    connection.send(("stop", ()))
+                    ok, _ = connection.recv()
+                    saved = saved and bool(ok)
+                except (OSError, EOFError):
+                    print(f"[ERROR] Shard {index} exited before saving.")
+                    saved = False
+                connection.close()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.connections = []
+        self.locks = []
+        return saved
+
+    # =========================
+    # Requests to shards
+    # =========================
+
+    @staticmethod
+    def __result(reply):
+        ok, value = reply
+        if ok:
+            return value
+        error_type, message = value
+        if error_type == "PermissionError":
+            raise PermissionError(message)
+        if error_type in ("LookupError", "KeyError"):
+            raise LookupError(message)
+        if error_type == "TypeError":
+            raise TypeError(message)
+        if error_type == "CirculationError":
+            raise CirculationError(message)
+        raise Exception(message)
+
+    def __call(self, shard, op, *args):
+        with self.locks[shard]:
+            self.connections[shard].send((op, args))
+            reply = self.connections[shard].recv()
+        return self.__result(reply)
+
+    # runs {shard: (op, args)} on those shards in parallel and returns {shard: result}. If any
+    # shard failed, its error is raised once every shard has replied
+    def __call_many(self, calls):
+        shards = sorted(calls)
+        replies = {}
+        for shard in shards: # ascending, so concurrent fan-outs cannot deadlock
+            self.locks[shard].acquire()
+        try:
+            for shard in shards:
+                op, args = calls[shard]
+                self.connections[shard].send((op, args))
+            for shard in shards:
+                replies[shard] = self.connections[shard].recv()
+        finally:
+            for shard in shards:
+                self.locks[shard].release()
+        return {shard: self.__result(reply) for shard, reply in replies.items()}
+
+    # runs op(*args) on every shard; results in shard order
+    def __fan_out(self, op, *args):
+        results = self.__call_many({shard: (op, args) for shard in range(self.shards)})
+        return [results[shard] for shard in range(self.shards)]
+
+    def __shard_of_book(self, book_id):
+        return split_book_id(int(book_id), self.shards)[0]
+
+    # =========================
+    # Library API (IDs in, dicts out)
+    # =========================
+
+    def stats(self):
+        return self.__fan_out("ping")
+
+    # registers the user on every shard; returns their user ID
+    def register_user(self, username, roles):
+        with self.register_lock:
+            user_ids = set(self.__fan_out("register_user", username, list(roles)))
+        if len(user_ids) != 1:
+            raise RuntimeError(f"Shards gave {username} different user IDs: {sorted(user_ids)}")
+        return user_ids.pop()
+
+    def has_user(self, user_id):
+        return self.__call(0, "has_user", user_id)
+
+    # same arguments as Library.search_catalog; every shard is searched and the matches merged
+    # (by relevance: BM25 scores, computed with each shard's own term statistics)
+    def search_catalog(self, search_term, search_by, limit=None, offset=0, available_only=False):
+        if search_by.lower() == 'relevance' and limit is None:
+            limit = 20
+        wanted = None if limit is None else offset + limit
+        matches = []
+        for shard, results in enumerate(self.__fan_out("search", search_term, search_by, wanted, available_only)):
+            matches.extend((tuple(key) + (shard,), book) for key, book in results)
+        matches.sort(key=lambda match: match[0])
+        books = [book for key, book in matches]
+        if limit is None:
+            return books[offset:]
+        return books[offset:offset + limit]
+
+    def autocomplete(self, prefix, field='title', limit=10):
+        suggestions = set()
+        for results in self.__fan_out("autocomplete", prefix, field, limit):
+            suggestions.update(results)
+        return sorted(suggestions, key=str.lower)[:limit]
+
+    def checkout_item(self, book_id, user_id):
+        return self.__call(self.__shard_of_book(book_id), "checkout_item", book_id, user_id)
+
+    def return_item(self, book_id, user_id):
+        return self.__call(self.__shard_of_book(book_id), "return_item", book_id, user_id)
+
+    # items are (book_id, user_id) pairs; each shard runs its part as one batch (see
+    # Library.checkout_many). Results are in the order of items
+    def checkout_many(self, items):
+        return self.__batch("checkout_many", items)
+
+    def return_many(self, items):
+        return self.__batch("return_many", items)
+
+    def __batch(self, op, items):
+        items = [(int(book_id), user_id) for book_id, user_id in items]
+        positions = {} # shard -> positions in items
+        for position, (book_id, user_id) in enumerate(items):
+            positions.setdefault(self.__shard_of_book(book_id), []).append(position)
+        results = [None] * len(items)
+        if not positions:
+            return results
+        replies = self.__call_many({shard: (op, ([items[p] for p in shard_positions],))
+                                    for shard, shard_positions in positions.items()})
+        for shard, shard_results in replies.items():
+            for position, result in zip(positions[shard], shard_results):
+                results[position] = result
+        return results
+
+    # overdue copies on every shard, earliest due first
+    def check_overdue(self, admin_id):
+        records = [record for results in self.__fan_out("check_overdue", admin_id) for record in results]
+        records.sort(key=lambda record: record["return_date"])
+        return records
+
+    # Library.loan_summary over every shard, with users as IDs
+    def loan_summary(self, admin_id):
+        summary = {"loans": 0, "overdue": 0, "outstanding": {}, "overdue_by_user": {}, "late_fees": {}}
+        for part in self.__fan_out("loan_summary", admin_id):
+            summary["loans"] += part["loans"]
+            summary["overdue"] += part["overdue"]
+            for name in ("outstanding", "overdue_by_user", "late_fees"):
+                totals = summary[name]
+                for user_id, value in part[name].items():
+                    totals[user_id] = totals.get(user_id, 0) + value
+        summary["late_fees"] = {user_id: round(fee, 2) for user_id, fee in summary["late_fees"].items()}
+        return summary
+
+    def set_date(self, new_date, admin_id):
+        if not isinstance(new_date, date):
+            raise TypeError
+        return self.__fan_out("set_date", new_date, admin_id)[0]
+
+    # adds the book to the shard its title and author hash to; returns its book ID (None if not added)
+    def add_item(self, title, author, genre, subgenre, admin_id):
+        return self.__call(shard_of(title, author, self.shards), "add_item", title, author, genre, subgenre, admin_id)
+
+    def remove_item(self, book_id, admin_id):
+        return self.__call(self.__shard_of_book(book_id), "remove_item", book_id, admin_id)
+
+    # as Library.recommend_books: the genre the user has borrowed most (over every shard)
+    def recommend_books(self, user_id, max_recommendations=5):
+        history = {}
+        for part in self.__fan_out("checkout_history", user_id):
+            for genre, count in part.items():
+                history[genre] = history.get(genre, 0) + count
+        if not history:
+            return []
+        favorite_genre = max(history, key=history.get)
+        matches = []
+        for shard, results in enumerate(self.__fan_out("recommend", user_id, favorite_genre, max_recommendations)):
+            matches.extend(((local_id, shard), book) for local_id, book in results)
+        matches.sort(key=lambda match: match[0])
+        return [book for key, book in matches[:max_recommendations]]
+
+    # the user's checked-out copies and holds on every shard
+    def user_items(self, user_id):
+        items = {"checked_out": [], "holds": []}
+        for part in self.__fan_out("user_items", user_id):
+            items["checked_out"].extend(part["checked_out"])
+            items["holds"].extend(part["holds"])
+        return items
@@ -0,0 +1,220 @@
+# snapshot.py
+
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import pickle
+from models.book import Book
+from models.user import User
+from models.waitlist import Waitlist
+from auth.role import Role
+
+
+# Incremental snapshots for the pickle backend.
+#
+# A base snapshot is the whole (library, userbase) pickle. Between base
+# snapshots, each save writes a small segment file with only what the
+# library's ChangeTracker recorded: the state of changed books (copies,
+# waitlist, pending holds), changed user records and role assignments, and
+# removed books. Objects are referred to by book/user ID, so a segment can
+# be merged on top of the base when loading. Every snapshot has a sequence
+# number (library.snapshot_seq); segments no newer than the base are stale
+# leftovers and are ignored.
+
+
+def segment_path(base_path, seq):
+    return f"{base_path}.{seq:06d}.seg"
+
+# [(seq, path)] of the segments saved next to the base snapshot, oldest first
+def segment_paths(base_path):
+    segments = []
+    for path in glob.glob(glob.escape(base_path) + ".*.seg"):
+        try:
+            seq = int(path[len(base_path) + 1:-len(".seg")])
+        except ValueError:
+            continue
+        segments.append((seq, path))
+    return sorted(segments)
+
+
+# =========================
+# Writing
+# =========================
+
+def _user_id(user):
+    return None if user is None else user.user_id
+
+def _book_record(book):
+    return {
+        "title": book.name,
+        "author": book.author,
+        "genre": book.genre,
+        "subgenre": getattr(book, 'subgenre', None),
+        "copies": [(_user_id(book.borrower(slot)), book.borrow_date(slot), book.return_date(slot))
+                   for slot in range(book.num_copies)],
+        "waitlist": [user.user_id for user in book.waiting_users()],
+        "holds": [(user.user_id, pickup_by) for user, pickup_by in book.pending_holds()],
+    }
+
+# builds a segment from the library's pending changes (does not clear them)
+def make_segment(library):
+    changes = library.changes
+    return {
+        "seq": library.snapshot_seq,
+        "meta": {
+            "current_date": library.current_date,
+            "default_checkout_window": library.default_checkout_window,
+            "user_id_counter": library.user_id_counter,
+            "next_book_id": library.next_book_id,
+            "journal_seq": library.journal_seq,
+        },
+        "books": {book_id: _book_record(book) for book_id, book in changes.books.items()
+                  if library.books_by_id.get(book_id) is book},
+        "removed_books": sorted(changes.removed_books),
+        "users": {user_id: (user.username, dict(user.checkout_history)) for user_id, user in changes.users.items()},
+        # None when the user no longer has any roles
+        "roles": {username: [(role.name, sorted(role.permissions)) for role in library.ac.user_roles[username]]
+                  if username in library.ac.user_roles else None
+                  for username in changes.roles},
+    }
+
+# replaces the file at path with data so that a crash leaves either the old or the new
+# file, never a partial one: write a temporary file, fsync it, then rename it over path
+def atomic_write(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    # make the rename itself durable (not possible on every platform)
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+# deletes the segments a new base snapshot already contains
+def remove_segments(base_path, up_to_seq):
+    for seq, path in segment_paths(base_path):
+        if seq <= up_to_seq:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"[PERSISTENCE] Could not remove old snapshot segment {path}: {e}")
+
+
+# =========================
+# Loading
+# =========================
+
+# merges every segment newer than the loaded base into (library, userbase).
+# Returns the number of segments applied
+def apply_segments(base_path, library, userbase):
+    applied = 0
+    changed = {} # book ID -> Book whose state a segment replaced
+    removed = [] # Books a segment removed
+    for seq, path in segment_paths(base_path):
+        if seq <= library.snapshot_seq:
+            continue
+        with open(path, 'rb') as f:
+            segment = pickle.load(f)
+        apply_segment(library, userbase, segment, changed, removed)
+        library.snapshot_seq = seq
+        applied += 1
+    if applied:
+        relink_users(library, userbase)
+        # only the books the segments touched are re-indexed
+        library.reindex_books(changed.values(), removed)
+        library.changes.clear()
+    return applied
+
+# merges one segment; the books whose state it replaces are added to changed ({book ID: Book})
+# and the books it removes to removed
+def apply_segment(library, userbase, segment, changed, removed):
+    for name, value in segment["meta"].items():
+        setattr(library, name, value)
+
+    for user_id, (username, checkout_history) in segment["users"].items():
+        user = userbase.get(user_id)
+        if user is None:
+            user = User(username)
+            user.user_id = user_id
+            userbase[user_id] = user
+        user.checkout_history = checkout_history
+
+    for username, roles in segment["roles"].items():
+        library.ac.revoke_roles(username)
+        if roles is None:
+            continue
+        for name, permissions in roles:
+            role = library.ac.find_role(name)
+            if role is None:
+                role = Role(name, permissions)
+            library.ac.assign_role(username, role)
+
+    removed_ids = set(segment["removed_books"])
+    if removed_ids:
+        for book_id in removed_ids:
+            book = library.books_by_id.pop(book_id, None)
+            changed.pop(book_id, None)
+            if book is not None:
+                removed.append(book)
+        library.inventory = [book for book in library.inventory if book.book_id not in removed_ids]
+
+    # books added since the base keep the order they were added in (their IDs are increasing)
+    for book_id in sorted(segment["books"]):
+        record = segment["books"][book_id]
+        book = library.books_by_id.get(book_id)
+        if book is None:
+            book = Book(record["title"], record["author"], record["genre"], record["subgenre"])
+            book.book_id = book_id
+            library.books_by_id[book_id] = book
+            library.inventory.append(book)
+        _restore_book_state(book, record, userbase)
+        changed[book_id] = book
+
+def _restore_book_state(book, record, userbase):
+    for slot, (borrower_id, borrow_date, return_date) in enumerate(record["copies"][:book.num_copies]):
+        borrower = None if borrower_id is None else userbase.get(borrower_id)
+        if borrower is None:
+            book.set_copy(slot, None, None, None)
+        else:
+            book.set_copy(slot, borrower, borrow_date, return_date)
+    if not record["waitlist"] and not record["holds"]:
+        book.waitlist = None
+        return
+    waitlist = Waitlist(book)
+    for user_id in record["waitlist"]:
+        user = userbase.get(user_id)
+        if user is not None:
+            waitlist.add_to_queue(user)
+    for user_id, pickup_by in record["holds"]:
+        user = userbase.get(user_id)
+        if user is not None:
+            waitlist.holds_pending.add((user, pickup_by))
+    book.waitlist = waitlist
+
+# rebuilds every user's checked-out items, holds and hold index from the books, since
+# segments only store the book side of each reference
+def relink_users(library, userbase):
+    for user in userbase.values():
+        user.items_checked_out = []
+        user.items_on_hold = []
+        user.holds_pending = {}
+    for book in library.inventory:
+        for slot, borrower, return_date in book.checked_out_copies():
+            borrower.items_checked_out.append((book, book.get_copy(slot)))
+        for user in book.waiting_users():
+            user.items_on_hold.append(book)
+        for user, pickup_by in book.pending_holds():
+            user.holds_pending[book] = pickup_by
+            user.items_on_hold.append(book)
+    for user in userbase.values():
+        user.items_checked_out.sort(key=lambda item: item[1]["borrow_date"])
@@ -0,0 +1,444 @@
+# sqlite_store.py
+
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import pickle
+import sqlite3
+import threading
+from datetime import date
+from models.library import Library
+from models.book import Book
+from models.user import User
+from models.catalog_index import CatalogIndex
+from auth.role import Role
+from auth.access_control import AccessControl
+from userbase import LazyUserbase
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS books (
+    book_id INTEGER PRIMARY KEY,
+    position INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    genre TEXT NOT NULL,
+    subgenre TEXT
+);
+CREATE TABLE IF NOT EXISTS copies (
+    book_id INTEGER NOT NULL,
+    slot INTEGER NOT NULL,
+    borrower_id TEXT,
+    borrow_date TEXT,
+    return_date TEXT,
+    PRIMARY KEY (book_id, slot)
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    checkout_history TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS roles (
+    name TEXT PRIMARY KEY,
+    permissions TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_roles (
+    username TEXT NOT NULL,
+    role_name TEXT NOT NULL,
+    PRIMARY KEY (username, role_name)
+);
+CREATE TABLE IF NOT EXISTS waitlist (
+    book_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (book_id, position)
+);
+CREATE TABLE IF NOT EXISTS holds (
+    book_id INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    pickup_by TEXT NOT NULL,
+    PRIMARY KEY (book_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS index_cache (
+    name TEXT PRIMARY KEY,
+    catalog_seq INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS copies_by_borrower ON copies (borrower_id);
+CREATE INDEX IF NOT EXISTS copies_by_return_date ON copies (return_date);
+CREATE INDEX IF NOT EXISTS waitlist_by_user ON waitlist (user_id);
+CREATE INDEX IF NOT EXISTS holds_by_user ON holds (user_id);
+"""
+
+
+def _iso(d):
+    return None if d is None else d.isoformat()
+
+def _date(text):
+    return None if text is None else date.fromisoformat(text)
+
+
+# the search index is stored with books referred to by ID, and read back onto the loaded books
+class _IndexPickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        return obj.book_id if isinstance(obj, Book) else None
+
+class _IndexUnpickler(pickle.Unpickler):
+    def __init__(self, file, books):
+        super().__init__(file)
+        self.books = books
+
+    def persistent_load(self, book_id):
+        book = self.books.get(book_id)
+        if book is None:
+            raise pickle.UnpicklingError(f"book {book_id} is not in the catalog")
+        return book
+
+
+class SQLiteStore:
+    """
+    SQLite storage backend for the Library and userbase.
+
+    Books, copies, users, roles, waitlist entries and pending holds live in
+    indexed tables. Once attached to a Library (as library.journal), every
+    mutation is written as targeted row updates for just the books and users
+    it touched, in one transaction, instead of dumping the whole state.
+
+    The connection is shared by every thread (operations run concurrently,
+    and lazily loaded users are read on whichever thread first needs them);
+    self.lock serializes its use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.conn.executescript(SCHEMA)
+        self.library = None
+        self.userbase = None
+        self.roles = None # role name -> Role, read once
+        self.catalog_seq = 0 # catalog changes (books added or removed) ever applied
+        self.index_seq = None # catalog_seq of the stored search index
+
+    def close(self):
+        self.conn.close()
+
+    # True for a database no library has been stored in yet. Every write records the library
+    # settings in meta, so this does not depend on the catalog (which may well be empty)
+    def is_new(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM meta").fetchone()[0] == 0
+
+    # =========================
+    # Library journal interface
+    # =========================
+
+    def attach(self, library, userbase):
+        self.library = library
+        self.userbase = userbase
+        library.journal = self
+
+    # rows are only written once the operation has been applied (below)
+    def append(self, seq, op, args):
+        pass
+
+    # users are the User objects the operation changed; they are written as they are rather
+    # than looked up again, since the userbase may hand out a different object by now
+    def applied(self, seq, op, args, users=()):
+        with self.lock:
+            library = self.library
+            changed = {user.user_id: user for user in users}
+            get_user = lambda user_id: changed.get(user_id) or self.userbase.get(user_id)
+            with self.conn:
+                if op == "register_user":
+                    self.__write_user(self.userbase[args["user_id"]])
+                    self.__write_roles(args["username"])
+                elif op in ("checkout", "return"):
+                    self.__write_book_state(library.books_by_id.get(args["book_id"]))
+                    self.__write_user(get_user(args["user_id"]))
+                elif op in ("checkout_many", "return_many"):
+                    for book_id in {book_id for book_id, user_id in args["items"]}:
+                        self.__write_book_state(library.books_by_id.get(book_id))
+                    for user_id in {user_id for book_id, user_id in args["items"]}:
+                        self.__write_user(get_user(user_id))
+                elif op == "add_item":
+                    self.catalog_seq += 1
+                    book = library.books_by_id.get(args["book_id"])
+                    if book is not None:
+                        self.__write_book(book, library.catalog_index.order.get(book, 0))
+                elif op == "ingest_many":
+                    self.catalog_seq += 1
+                    for book_id in range(args["first_book_id"], library.next_book_id):
+                        book = library.books_by_id.get(book_id)
+                        if book is not None:
+                            self.__write_book(book, library.catalog_index.order.get(book, 0))
+                elif op == "remove_item":
+                    self.catalog_seq += 1
+                    self.__delete_book(args["book_id"])
+                elif op == "cleanup_user":
+                    for book_id in args["book_ids"]:
+                        self.__write_book_state(library.books_by_id.get(book_id))
+                    user = self.userbase.get(args["user_id"])
+                    if user is not None:
+                        self.conn.execute("DELETE FROM user_roles WHERE username = ?", (user.username,))
+                self.__write_meta(library)
+
+    # every operation is already stored, so a save only records the library settings (and
+    # the search index, if the catalog changed since it was stored)
+    def flush(self):
+        if self.library is None:
+            return
+        # the index is captured under the library lock, taken before the store's (as operations do)
+        with self.library.lock.shared():
+            with self.lock:
+                with self.conn:
+                    self.__write_meta(self.library)
+                self.save_index(self.library)
+
+    # =========================
+    # Row writers
+    # =========================
+
+    def __write_meta(self, library):
+        meta = {
+            "current_date": library.current_date.isoformat(),
+            "default_checkout_window": library.default_checkout_window,
+            "user_id_counter": library.user_id_counter,
+            "next_book_id": library.next_book_id,
+            "journal_seq": library.journal_seq,
+            "catalog_seq": self.catalog_seq,
+        }
+        self.conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                              [(key, json.dumps(value)) for key, value in meta.items()])
+
+    def __write_user(self, user):
+        if user is None:
+            return
+        self.conn.execute("INSERT OR REPLACE INTO users (user_id, username, checkout_history) VALUES (?, ?, ?)",
+                          (user.user_id, user.username, json.dumps(user.checkout_history)))
+
+    def __write_roles(self, username):
+        roles = self.library.ac.user_roles.get(username, set())
+        for role in roles:
+            self.conn.execute("INSERT OR REPLACE INTO roles (name, permissions) VALUES (?, ?)",
+                              (role.name, json.dumps(sorted(role.permissions))))
+            if self.roles is not None:
+                self.roles.setdefault(role.name, role)
+            self.conn.execute("INSERT OR IGNORE INTO user_roles (username, role_name) VALUES (?, ?)",
+                              (username, role.name))
+
+    def __write_book(self, book, position):
+        self.conn.execute("INSERT OR REPLACE INTO books (book_id, position, title, author, genre, subgenre) "
+                          "VALUES (?, ?, ?, ?, ?, ?)",
+                          (book.book_id, position, book.name, book.author, book.genre, getattr(book, 'subgenre', None)))
+        self.__write_book_state(book)
+
+    # copies, waitlist and pending holds of one book
+    def __write_book_state(self, book):
+        if book is None:
+            return
+        self.conn.executemany("INSERT OR REPLACE INTO copies (book_id, slot, borrower_id, borrow_date, return_date) "
+                              "VALUES (?, ?, ?, ?, ?)",
+                              [(book.book_id, slot,
+                                book.borrower(slot).user_id if book.borrower(slot) is not None else None,
+                                _iso(book.borrow_date(slot)), _iso(book.return_date(slot)))
+                               for slot in range(book.num_copies)])
+        self.conn.execute("DELETE FROM waitlist WHERE book_id = ?", (book.book_id,))
+        self.conn.executemany("INSERT INTO waitlist (book_id, position, user_id) VALUES (?, ?, ?)",
+                              [(book.book_id, pos, user.user_id) for pos, user in enumerate(book.waiting_users())])
+        self.conn.execute("DELETE FROM holds WHERE book_id = ?", (book.book_id,))
+        self.conn.executemany("INSERT INTO holds (book_id, user_id, pickup_by) VALUES (?, ?, ?)",
+                              [(book.book_id, user.user_id, _iso(pickup_by))
+                               for user, pickup_by in book.pending_holds()])
+
+    def __delete_book(self, book_id):
+        for table in ("books", "copies", "waitlist", "holds"):
+            self.conn.execute(f"DELETE FROM {table} WHERE book_id = ?", (book_id,))
+
+    # writes the whole state (used once, when a library is first stored in a new database).
+    # Only the catalog tables are replaced: users and their roles are added to, never cleared
+    def save_all(self, library, userbase):
+        with self.lock:
+            with self.conn:
+                for table in ("books", "copies", "waitlist", "holds"):
+                    self.conn.execute(f"DELETE FROM {table}")
+                for user in userbase.values():
+                    self.__write_user(user)
+                self.library = library
+                for username in library.ac.user_roles:
+                    self.__write_roles(username)
+                for position, book in enumerate(library.inventory):
+                    self.__write_book(book, position)
+                self.__write_meta(library)
+
+    # stores the library's search index unless the stored one is already current
+    def save_index(self, library):
+        with self.lock:
+            if self.index_seq == self.catalog_seq:
+                return
+            data = io.BytesIO()
+            _IndexPickler(data, protocol=pickle.HIGHEST_PROTOCOL).dump(library.catalog_index)
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO index_cache (name, catalog_seq, data) VALUES (?, ?, ?)",
+                                  ("catalog", self.catalog_seq, data.getvalue()))
+            self.index_seq = self.catalog_seq
+
+    # the stored search index, if it is current for the catalog in books ({book_id: Book}), else None
+    def load_index(self, books):
+        row = self.conn.execute("SELECT catalog_seq, data FROM index_cache WHERE name = 'catalog'").fetchone()
+        if row is None or row[0] != self.catalog_seq:
+            return None
+        try:
+            index = _IndexUnpickler(io.BytesIO(row[1]), books).load()
+        except Exception as e:
+            print(f"[PERSISTENCE] Stored search index could not be read ({e}). Rebuilding it.")
+            return None
+        if getattr(index, 'version', None) != CatalogIndex.VERSION or len(index) != len(books):
+            return None
+        self.index_seq = row[0]
+        return index
+
+    # =========================
+    # Loading
+    # =========================
+
+    def load_meta(self):
+        return {key: json.loads(value) for key, value in self.conn.execute("SELECT key, value FROM meta")}
+
+    # builds a User object from its row (items_checked_out / holds are filled in from the books)
+    @staticmethod
+    def user_from_row(row):
+        user_id, username, checkout_history = row
+        user = User(username)
+        user.user_id = user_id
+        user.checkout_history = json.loads(checkout_history)
+        return user
+
+    # reads one user (and their roles, into the attached library's AccessControl)
+    def load_user(self, user_id):
+        with self.lock:
+            row = self.conn.execute("SELECT user_id, username, checkout_history FROM users WHERE user_id = ?",
+                                    (user_id,)).fetchone()
+            if row is None:
+                return None
+            user = self.user_from_row(row)
+            if self.library is not None:
+                self.load_user_roles(self.library.ac, user.username)
+            return user
+
+    def has_user(self, user_id):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def count_users(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def user_ids(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT user_id FROM users ORDER BY user_id")]
+
+    def delete_user(self, user_id):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+
+    def __role_objects(self):
+        if self.roles is None:
+            self.roles = {name: Role(name, json.loads(permissions))
+                          for name, permissions in self.conn.execute("SELECT name, permissions FROM roles")}
+        return self.roles
+
+    def load_roles(self, ac):
+        roles = self.__role_objects()
+        for username, role_name in self.conn.execute("SELECT username, role_name FROM user_roles"):
+            if role_name in roles:
+                ac.assign_role(username, roles[role_name])
+
+    def load_user_roles(self, ac, username):
+        with self.lock:
+            roles = self.__role_objects()
+            for (role_name,) in self.conn.execute("SELECT role_name FROM user_roles WHERE username = ?", (username,)):
+                if role_name in roles:
+                    ac.assign_role(username, roles[role_name])
+
+    # rebuilds (library, userbase) from the tables. With lazy_users, only the users the
+    # books refer to are read now; the rest are read on first access (see userbase.py)
+    def load(self, lazy_users=False):
+        meta = self.load_meta()
+        library = Library(AccessControl())
+        library.current_date = _date(meta.get("current_date")) or library.current_date
+        library.default_checkout_window = meta.get("default_checkout_window", library.default_checkout_window)
+        library.user_id_counter = meta.get("user_id_counter", 0)
+        library.journal_seq = meta.get("journal_seq", 0)
+        self.catalog_seq = meta.get("catalog_seq", 0)
+
+        if lazy_users:
+            users = {}
+            for row in self.conn.execute(
+                    "SELECT user_id, username, checkout_history FROM users WHERE user_id IN ("
+                    "SELECT borrower_id FROM copies WHERE borrower_id IS NOT NULL "
+                    "UNION SELECT user_id FROM waitlist UNION SELECT user_id FROM holds)"):
+                user = self.user_from_row(row)
+                users[user.user_id] = user
+                self.load_user_roles(library.ac, user.username)
+            userbase = LazyUserbase(self, users)
+        else:
+            users = {}
+            for row in self.conn.execute("SELECT user_id, username, checkout_history FROM users"):
+                user = self.user_from_row(row)
+                users[user.user_id] = user
+            self.load_roles(library.ac)
+            userbase = users
+
+        self.load_books(library, users.get)
+        return library, userbase
+
+    # loads every book with its copies, waitlist and holds. get_user(user_id) resolves borrowers
+    def load_books(self, library, get_user):
+        books = {}
+        for book_id, title, author, genre, subgenre in self.conn.execute(
+                "SELECT book_id, title, author, genre, subgenre FROM books ORDER BY position"):
+            book = Book(title, author, genre, subgenre)
+            book.book_id = book_id
+            books[book_id] = book
+            library.inventory.append(book)
+
+        for book_id, slot, borrower_id, borrow_date, return_date in self.conn.execute(
+                "SELECT book_id, slot, borrower_id, borrow_date, return_date FROM copies "
+                "WHERE borrower_id IS NOT NULL ORDER BY borrow_date"):
+            book = books.get(book_id)
+            user = get_user(borrower_id)
+            if book is None or user is None or slot >= book.num_copies:
+                continue
+            book.set_copy(slot, user, _date(borrow_date), _date(return_date))
+            user.items_checked_out.append((book, book.get_copy(slot)))
+
+        for book_id, user_id in self.conn.execute(
+                "SELECT book_id, user_id FROM waitlist ORDER BY book_id, position"):
+            book = books.get(book_id)
+            user = get_user(user_id)
+            if book is None or user is None:
+                continue
+            book.waitlist.add_to_queue(user)
+            user.items_on_hold.append(book)
+
+        for book_id, user_id, pickup_by in self.conn.execute("SELECT book_id, user_id, pickup_by FROM holds"):
+            book = books.get(book_id)
+            user = get_user(user_id)
+            if book is None or user is None:
+                continue
+            pickup_by = _date(pickup_by)
+            book.waitlist.holds_pending.add((user, pickup_by))
+            user.holds_pending[book] = pickup_by
+            user.items_on_hold.append(book)
+
+        library.next_book_id = max(self.load_meta().get("next_book_id", 1), max(books, default=0) + 1)
+        # free-lists and due-date indexes; the search index is read back if the catalog has not
+        # changed since it was stored, and otherwise rebuilt and stored for the next start
+        library.rebuild_indexes(self.load_index(books))
+        self.save_index(library)
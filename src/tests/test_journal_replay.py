@@ -0,0 +1,66 @@
+# test_journal_replay.py
+
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth.role import Role
+from journal import Journal
+from models.book import Book
+from models.library import Library
+
+
+class JournalReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "journal.jsonl")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    # a fresh library and userbase with one admin, as a snapshot taken before the journal started
+    def new_library(self):
+        library = Library()
+        userbase = {}
+        admin_role = Role('admin', ['add_item', 'remove_item'])
+        admin_id, admin = library.register_user(userbase, 'admin', [admin_role])
+        return library, userbase, admin
+
+    def replayed(self, journal_seq):
+        library, userbase, admin = self.new_library()
+        library.journal_seq = journal_seq
+        Journal(self.path).replay(library, userbase)
+        return library
+
+    # a removed book added back keeps its ID; replaying the remove and the re-add must
+    # land on the same IDs, or later records would refer to the wrong book
+    def test_remove_then_readd(self):
+        library, userbase, admin = self.new_library()
+        start_seq = library.journal_seq
+        journal = Journal(self.path)
+        library.journal = journal
+        first = Book('Dune', 'Frank Herbert', 'Science Fiction')
+        other = Book('Emma', 'Jane Austen', 'Romance')
+        library.add_item(first, admin)
+        library.add_item(other, admin)
+        library.remove_item(first, admin)
+        library.add_item(first, admin)
+        library.remove_item(other, admin)
+        journal.close()
+
+        replayed = self.replayed(start_seq)
+        self.assertEqual(sorted(replayed.books_by_id), sorted(library.books_by_id))
+        self.assertEqual(replayed.books_by_id[first.book_id].name, 'Dune')
+        self.assertNotIn(other.book_id, replayed.books_by_id)
+        self.assertEqual(replayed.next_book_id, library.next_book_id)
+        self.assertEqual(replayed.journal_seq, library.journal_seq)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# userbase.py
+
+# -*- coding: utf-8 -*-
+
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+
+class LazyUserbase(MutableMapping):
+    """
+    Behaves like the {ID: User} userbase dict, but users are read from the
+    SQLite store the first time they are accessed instead of all at startup.
+
+    Users referenced by the library's circulation state (borrowers, waitlisted
+    users, pending holds) are pinned in memory, since books hold references to
+    them. Everyone else is kept in an LRU cache of at most `capacity` users;
+    the store is updated as each operation is applied, so evicting a user
+    never loses data. A user evicted while still referenced elsewhere (by a
+    GUI session, a request being handled) stays reachable through a weak
+    reference until the last reference goes, so a lookup never returns a
+    second User object for someone who is still in use.
+
+    The cache is guarded by the store's lock, which the store also holds
+    while it looks users up here, so the two can never be taken in opposite
+    orders.
+    """
+
+    def __init__(self, store, pinned=None, capacity=1000):
+        self.store = store
+        self.pinned = dict(pinned or {})
+        self.cache = OrderedDict()
+        self.evicted = weakref.WeakValueDictionary() # evicted users that may still be in use
+        self.capacity = capacity
+        self.faults = 0 # number of users read from the store
+
+    def __getitem__(self, user_id):
+        user = self.pinned.get(user_id)
+        if user is not None:
+            return user
+        with self.store.lock:
+            user = self.cache.get(user_id)
+            if user is not None:
+                self.cache.move_to_end(user_id)
+                return user
+
+            user = self.evicted.pop(user_id, None)
+            if user is None:
+                user = self.store.load_user(user_id)
+                if user is None:
+                    raise KeyError(user_id)
+                self.faults += 1
+            self.__cache(user_id, user)
+            return user
+
+    # new users are written to the store by the library (register_user), so only cache them here
+    def __setitem__(self, user_id, user):
+        with self.store.lock:
+            if user_id in self.pinned:
+                self.pinned[user_id] = user
+            else:
+                self.__cache(user_id, user)
+
+    def __delitem__(self, user_id):
+        with self.store.lock:
+            if user_id not in self:
+                raise KeyError(user_id)
+            self.pinned.pop(user_id, None)
+            self.cache.pop(user_id, None)
+            self.evicted.pop(user_id, None)
+            self.store.delete_user(user_id)
+
+    def __contains__(self, user_id):
+        return (user_id in self.pinned or user_id in self.cache or user_id in self.evicted
+                or self.store.has_user(user_id))
+
+    def __iter__(self):
+        return iter(self.store.user_ids())
+
+    def __len__(self):
+        return self.store.count_users()
+
+    def __cache(self, user_id, user):
+        self.cache[user_id] = user
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.capacity:
+            old_id, old_user = self.cache.popitem(last=False)
+            # users who now have books out or on hold are referenced by those books: keep them
+            if old_user.items_checked_out or old_user.items_on_hold:
+                self.pinned[old_id] = old_user
+            else:
+                self.evicted[old_id] = old_user